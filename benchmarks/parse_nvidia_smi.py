@@ -0,0 +1,49 @@
+import argparse
+import timeit
+
+from os.path import join, dirname
+
+from gpuscheduler.core import parse_nvidia_smi_xml, parse_nvidia_smi_csv
+
+parser = argparse.ArgumentParser('Micro-benchmark of the nvidia-smi parsers on recorded output.')
+parser.add_argument('--number', type=int, default=200, help='Number of parses per timing.')
+parser.add_argument('--repeat', type=int, default=5, help='Number of timings. The best one is reported.')
+args = parser.parse_args()
+
+fixture_dir = join(dirname(__file__), 'fixtures')
+with open(join(fixture_dir, 'nvidia_smi_8gpu.xml')) as f:
+    xml_text = f.read()
+with open(join(fixture_dir, 'nvidia_smi_8gpu.csv')) as f:
+    csv_text = f.read()
+
+def parse_nvidia_smi_bs4(text):
+    # the BeautifulSoup implementation that SshScheduler.parse_nvidia_smi used before
+    from bs4 import BeautifulSoup
+    xml_soup = BeautifulSoup(text, 'xml')
+    gpus = []
+    for gpu_node in xml_soup.find_all('gpu'):
+        gpu = {}
+        gpu['name'] = gpu_node.product_name.text
+        gpu['device_id'] = int(gpu_node.minor_number.text)
+        gpu['utilization'] = int(gpu_node.gpu_util.text[:-2])
+        gpu['total_mem'] = int(gpu_node.fb_memory_usage.total.text[:-4])
+        gpu['used_mem'] = int(gpu_node.fb_memory_usage.used.text[:-4])
+        gpu['free_mem'] = int(gpu_node.fb_memory_usage.free.text[:-4])
+        gpus.append(gpu)
+    return gpus
+
+parsers = []
+parsers.append(('bs4 xml (old)', parse_nvidia_smi_bs4, xml_text))
+parsers.append(('streaming xml', parse_nvidia_smi_xml, xml_text))
+parsers.append(('csv query', parse_nvidia_smi_csv, csv_text))
+
+reference = parse_nvidia_smi_bs4(xml_text)
+for name, func, text in parsers:
+    assert func(text) == reference, 'Parser {0} disagrees with the old implementation!'.format(name)
+
+print('Input sizes: xml {0} bytes, csv {1} bytes.'.format(len(xml_text), len(csv_text)))
+baseline = None
+for name, func, text in parsers:
+    best = min(timeit.repeat(lambda: func(text), number=args.number, repeat=args.repeat))/args.number
+    if baseline is None: baseline = best
+    print('{0:>15}: {1:8.1f} us per parse ({2:5.1f}x)'.format(name, best*1e6, baseline/best))
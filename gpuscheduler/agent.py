@@ -0,0 +1,78 @@
+"""Resident GPU telemetry agent.
+
+SshScheduler starts this script on every host by piping it to a remote
+python (python3 -u - <args>), so it may only use the standard library. The
+agent keeps one nvidia-smi process in loop mode and writes one JSON line to
+stdout for each event:
+
+    {"gpus": [{...}, ...]}              full state of all GPUs at start-up
+    {"d": [device_id, used, free, util]} a GPU changed by more than the deltas
+    {"h": timestamp}                    heartbeat if nothing changed for a while
+
+The agent exits as soon as the scheduler closes the ssh channel.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+LOOP_QUERY = 'nvidia-smi --query-gpu=pci.bus_id,memory.used,memory.free,utilization.gpu --format=csv,noheader,nounits -lms {0}'
+
+def emit(msg):
+    sys.stdout.write(json.dumps(msg, separators=(',', ':')) + '\n')
+    sys.stdout.flush()
+
+def snapshot():
+    """Returns the full GPU state and a map from pci bus id to minor number."""
+    text = subprocess.check_output(['nvidia-smi', '-q', '-x'], universal_newlines=True)
+    gpus = []
+    bus2device = {}
+    for node in ET.fromstring(text).iter('gpu'):
+        gpu = {}
+        gpu['name'] = node.findtext('product_name')
+        gpu['device_id'] = int(node.findtext('minor_number'))
+        gpu['utilization'] = int(node.findtext('utilization/gpu_util').split()[0])
+        gpu['total_mem'] = int(node.findtext('fb_memory_usage/total').split()[0])
+        gpu['used_mem'] = int(node.findtext('fb_memory_usage/used').split()[0])
+        gpu['free_mem'] = int(node.findtext('fb_memory_usage/free').split()[0])
+        bus2device[node.get('id').upper()] = gpu['device_id']
+        gpus.append(gpu)
+    return gpus, bus2device
+
+def main():
+    parser = argparse.ArgumentParser('GPU telemetry agent.')
+    parser.add_argument('--interval-ms', type=int, default=500, help='Sampling interval of nvidia-smi.')
+    parser.add_argument('--mem-delta', type=int, default=64, help='Smallest memory change in MiB that is reported.')
+    parser.add_argument('--util-delta', type=int, default=5, help='Smallest utilization change in percent that is reported.')
+    parser.add_argument('--heartbeat', type=float, default=10.0, help='Seconds without a message after which a heartbeat is sent.')
+    args = parser.parse_args()
+
+    gpus, bus2device = snapshot()
+    emit({'gpus': gpus})
+    last = dict((gpu['device_id'], (gpu['used_mem'], gpu['free_mem'], gpu['utilization'])) for gpu in gpus)
+    last_emit = time.time()
+
+    proc = subprocess.Popen(LOOP_QUERY.format(args.interval_ms).split(' '), stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        for line in proc.stdout:
+            values = [value.strip() for value in line.split(',')]
+            if len(values) != 4 or values[0].upper() not in bus2device: continue
+            device_id = bus2device[values[0].upper()]
+            used, free, util = [int(value) for value in values[1:]]
+            prev_used, prev_free, prev_util = last[device_id]
+            if abs(used - prev_used) >= args.mem_delta or abs(util - prev_util) >= args.util_delta:
+                last[device_id] = (used, free, util)
+                emit({'d': [device_id, used, free, util]})
+                last_emit = time.time()
+            elif time.time() - last_emit > args.heartbeat:
+                emit({'h': time.time()})
+                last_emit = time.time()
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+    finally:
+        proc.terminate()
+
+if __name__ == '__main__':
+    main()
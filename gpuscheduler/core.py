@@ -7,18 +7,53 @@ import threading
 import uuid
 import operator
 import datetime
-import shutil
 import time
 import numpy as np
 import copy
 import hashlib
+import json
+import sqlite3
+import xml.etree.ElementTree as ET
 
-from queue import Queue
+from queue import Queue, Empty
+from collections import OrderedDict
 from os.path import join
+from concurrent.futures import ThreadPoolExecutor, wait
 from aenum import Enum
 
 MEM_THRESHOLD_AVAILABLE = 300
 UTILIZARTION_THERESHOLD_AVAILABLE = 5
+POLL_MAX_WORKERS = 16
+POLL_TIMEOUT_SECONDS = 30
+POLL_WAIT_SECONDS = 10
+HOST_BACKOFF_SECONDS = 30
+CLUSTER_STATE_TTL_SECONDS = 60
+HOST_MAX_BACKOFF_SECONDS = 1800
+ERROR_TAIL_BYTES = 4096
+PACK_MEM_MARGIN_MB = 512
+PACK_UTIL_THRESHOLD = 70
+PACK_MAX_JOBS = 4
+TOPOLOGY_LINK_COST = {'PIX': 10, 'PXB': 20, 'PHB': 30, 'NODE': 40, 'SOC': 50, 'SYS': 50}
+NVIDIA_SMI_QUERIES = {}
+NVIDIA_SMI_QUERIES['xml'] = 'nvidia-smi -q -x'
+NVIDIA_SMI_QUERIES['csv'] = 'nvidia-smi --query-gpu=name,index,utilization.gpu,memory.total,memory.used,memory.free --format=csv,noheader,nounits'
+AGENT_PYTHON = 'python3'
+AGENT_INTERVAL_MS = 500
+AGENT_TIMEOUT_SECONDS = 30
+SSH_CONTROL_DIR = '/tmp/gpuscheduler/ssh'
+SSH_IDLE_SECONDS = 600
+SSH_CHECK_INTERVAL_SECONDS = 30
+SSH_CONNECT_TIMEOUT_SECONDS = 5
+RSYNC_MAX_SIZE_MB = 10
+JOB_STORE_BATCH_SIZE = 10000
+SUBMIT_POLL_SECONDS = 60
+SUBMIT_WORKERS = 8
+SUBMIT_RETRIES = 6
+SUBMIT_BACKOFF_SECONDS = 2
+SUBMIT_MAX_BACKOFF_SECONDS = 120
+SBATCH_RETRY_ERRORS = ['Socket timed out', 'QOSMaxSubmitJobPerUserLimit']
+COMPLETION_LINE = 'gpuscheduler: finished {0}'
+COMPLETION_FILE = '.gpuscheduler_finished'
 
 class HostState(Enum):
     unknown = 0
@@ -30,9 +65,58 @@ class GPUStatus(Enum):
     available = 1
     busy = 2
 
-def cmd_over_ssh(name, script):
-    strCMD = 'ssh {0} bash -l {1}'.format(name, script)
-    return execute_and_return(strCMD)
+class CircuitState(Enum):
+    closed = 0
+    open = 1
+    half_open = 2
+
+class JobState(Enum):
+    queued = 0
+    dispatched = 1
+    running = 2
+    finished = 3
+    failed = 4
+
+def stream_over_ssh(name, script, out_path, err_path, pool=None):
+    """Runs a script over ssh and streams its output into files.
+
+    :script: The text of the bash script.
+    :returns: The exit code of the ssh process.
+
+    """
+    ssh = 'ssh {0}'.format(name) if pool is None else pool.ssh(name)
+    return stream_script('{0} bash -l -s'.format(ssh), script, out_path, err_path)
+
+def stream_script(strCMD, script, out_path, err_path):
+    """Pipes a script to a shell command and streams its output into files.
+
+    The script is piped to the shell over stdin. It is wrapped in a group,
+    so bash reads all of it before running anything and the commands of
+    the script cannot consume their own source from stdin.
+
+    stdout and stderr of the process are handed directly to the log files,
+    so output appears on disk as it arrives and the scheduler does not
+    buffer any of it in memory.
+
+    :strCMD: A command which runs a shell that reads from stdin.
+    :returns: The exit code of the process.
+
+    """
+    with open(out_path, 'w') as out, open(err_path, 'w') as err:
+        proc = subprocess.Popen(shlex.split(strCMD), stdin=subprocess.PIPE, stdout=out, stderr=err, universal_newlines=True)
+        try:
+            proc.stdin.write('{{\n{0}\n}} < /dev/null\n'.format(script))
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        return proc.wait()
+
+def read_tail(path, num_bytes=ERROR_TAIL_BYTES):
+    """Reads at most the last num_bytes of a file."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - num_bytes, 0))
+        return f.read().decode('UTF-8', errors='replace').strip()
 
 def execute(strCMD):
     try:
@@ -42,15 +126,678 @@ def execute(strCMD):
 
 def execute_blocking(strCMD):
     proc = subprocess.Popen(strCMD, shell=True, universal_newlines=True)
-    proc.wait()
+    returncode = proc.wait()
     proc.terminate()
+    return returncode
 
-def execute_and_return(strCMD):
+def execute_and_return(strCMD, timeout=None):
     proc = subprocess.Popen(shlex.split(strCMD), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = proc.communicate()
+    try:
+        out, err = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        out, err = proc.communicate()
+        err += 'Timed out after {0} seconds.'.format(timeout).encode('UTF-8')
     out, err = out.decode("UTF-8").strip(), err.decode("UTF-8").strip()
     return out, err
 
+class SshConnectionPool(object):
+
+    """Keeps one long-lived multiplexed ssh master connection per host.
+
+    All ssh and rsync calls of the scheduler are routed through the
+    OpenSSH control socket of the host, so only the first call to a host
+    pays for the handshake and authentication. Masters are health checked
+    before use. They exit by themselves once no session used them for
+    idle_seconds (ControlPersist), so long running jobs and telemetry
+    agents which stream over a master keep it open.
+
+    """
+
+    def __init__(self, control_dir=SSH_CONTROL_DIR, idle_seconds=SSH_IDLE_SECONDS,
+                 check_interval=SSH_CHECK_INTERVAL_SECONDS, connect_timeout=SSH_CONNECT_TIMEOUT_SECONDS):
+        self.control_dir = control_dir
+        self.idle_seconds = idle_seconds
+        self.check_interval = check_interval
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        self.host_locks = {}
+        self.last_checked = {}
+
+    def control_path(self, host):
+        return join(self.control_dir, '{0}.sock'.format(host))
+
+    def options(self, host):
+        """Returns the ssh options which multiplex over the master of host."""
+        return '-o ControlMaster=no -o ControlPath={0} -o ConnectTimeout={1}'.format(
+            self.control_path(host), self.connect_timeout)
+
+    def is_alive(self, host):
+        """Checks if the master connection of host is up."""
+        if not os.path.exists(self.control_path(host)): return False
+        strCMD = 'ssh -o ControlPath={0} -O check {1}'.format(self.control_path(host), host)
+        return subprocess.call(shlex.split(strCMD), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+    def connect(self, host):
+        """Starts a master connection for host in the background."""
+        os.makedirs(self.control_dir, exist_ok=True)
+        strCMD = 'ssh -o ControlMaster=yes -o ControlPath={0} -o ControlPersist={1}s -o ConnectTimeout={2} -fN {3}'.format(
+            self.control_path(host), self.idle_seconds, self.connect_timeout, host)
+        try:
+            # -f forks the master into the background, so its output must not be piped to us
+            return subprocess.call(shlex.split(strCMD), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, timeout=self.connect_timeout + 5) == 0
+        except subprocess.TimeoutExpired:
+            return False
+
+    def acquire(self, host):
+        """Makes sure a healthy master connection to host exists.
+
+        If no master can be established the options still work: ssh falls
+        back to a direct connection when the control socket is missing.
+
+        """
+        with self.lock:
+            if host not in self.host_locks: self.host_locks[host] = threading.Lock()
+            host_lock = self.host_locks[host]
+        with host_lock:
+            now = time.time()
+            if now - self.last_checked.get(host, 0) > self.check_interval:
+                if not self.is_alive(host):
+                    self.connect(host)
+                self.last_checked[host] = now
+
+    def disconnect(self, host):
+        """Stops the master of host from taking new sessions. Open sessions run until they end."""
+        strCMD = 'ssh -o ControlPath={0} -O stop {1}'.format(self.control_path(host), host)
+        subprocess.call(shlex.split(strCMD), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.last_checked.pop(host, None)
+
+    def close(self):
+        for host in list(self.last_checked):
+            self.disconnect(host)
+
+    def ssh(self, host):
+        """Returns an ssh command prefix for host."""
+        self.acquire(host)
+        return 'ssh {0} {1}'.format(self.options(host), host)
+
+    def rsync(self, host):
+        """Returns an rsync command prefix for transfers to or from host."""
+        self.acquire(host)
+        return 'rsync -e "ssh {0}"'.format(self.options(host))
+
+
+class RepoSyncManager(object):
+
+    """Syncs a local repo to a host at most once per content hash.
+
+    The hash covers the relative path and the content of every file which
+    rsync would transfer (files up to max_size_mb). It is computed once per
+    repo until reset() is called, which run_jobs does at its start. Workers
+    which need the same repo on the same host while a transfer is running
+    wait for that transfer instead of starting their own.
+
+    """
+
+    def __init__(self, pool, max_size_mb=RSYNC_MAX_SIZE_MB):
+        self.pool = pool
+        self.max_size_mb = max_size_mb
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.syncs = {}
+
+    def reset(self):
+        """Forgets the repo hashes so that the next sync re-hashes the repos."""
+        with self.lock:
+            self.hashes = {}
+
+    def content_hash(self, repo_local):
+        with self.lock:
+            if repo_local in self.hashes: return self.hashes[repo_local]
+            start = time.time()
+            md5 = hashlib.md5()
+            for root, dirs, files in os.walk(repo_local):
+                dirs.sort()
+                for name in sorted(files):
+                    path = join(root, name)
+                    if os.path.islink(path) or os.path.getsize(path) > self.max_size_mb*1024*1024: continue
+                    md5.update(os.path.relpath(path, repo_local).encode('utf-8'))
+                    with open(path, 'rb') as f:
+                        for chunk in iter(lambda: f.read(1024*1024), b''):
+                            md5.update(chunk)
+            self.hashes[repo_local] = md5.hexdigest()
+            print('Hashed {0} in {1:.2f}s: {2}'.format(repo_local, time.time() - start, self.hashes[repo_local]))
+            return self.hashes[repo_local]
+
+    def sync(self, host, repo_local, repo_remote):
+        """Makes sure the current content of repo_local is on host.
+
+        :returns: True if the repo is in sync.
+
+        """
+        key = (host, repo_local, repo_remote)
+        content_hash = self.content_hash(repo_local)
+        with self.lock:
+            entry = self.syncs.get(key)
+            owner = entry is None or entry['hash'] != content_hash
+            if owner:
+                entry = {'hash': content_hash, 'done': threading.Event(), 'ok': False}
+                self.syncs[key] = entry
+        if not owner:
+            entry['done'].wait()
+            return entry['ok']
+
+        print('Performing rsync of {0} to {1}...'.format(repo_local, host))
+        rsync = '{0} --update -raz --progress --max-size={1}m {2} {3}:{4}/'.format(self.pool.rsync(host), self.max_size_mb, repo_local, host, repo_remote)
+        entry['ok'] = execute_blocking(rsync) == 0
+        if not entry['ok']:
+            print('Rsync of {0} to {1} failed!'.format(repo_local, host))
+            with self.lock:
+                if self.syncs.get(key) is entry: self.syncs.pop(key)
+        entry['done'].set()
+        return entry['ok']
+
+
+class SshExecutor(object):
+
+    """Runs commands on a host over ssh. The default backend of SshScheduler.
+
+    An executor runs single commands (run, popen), whole job scripts
+    (stream) and copies repos to the host (sync). SshScheduler looks up the
+    executor of every host, so hosts can use different backends.
+
+    """
+
+    def __init__(self, pool, syncer):
+        self.pool = pool
+        self.syncer = syncer
+
+    def run(self, host, cmd, timeout=None):
+        """Runs cmd on host. Returns its stdout and stderr."""
+        return execute_and_return('{0} "{1}"'.format(self.pool.ssh(host), cmd), timeout=timeout)
+
+    def popen(self, host, cmd, **kwargs):
+        """Starts cmd on host. kwargs are passed to subprocess.Popen."""
+        return subprocess.Popen(shlex.split('{0} "{1}"'.format(self.pool.ssh(host), cmd)), **kwargs)
+
+    def stream(self, host, script, out_path, err_path):
+        return stream_over_ssh(host, script, out_path, err_path, self.pool)
+
+    def sync(self, host, repo_local, repo_remote):
+        return self.syncer.sync(host, repo_local, repo_remote)
+
+
+class LocalExecutor(object):
+
+    """Runs commands as local subprocesses, for the machine the scheduler runs on.
+
+    Nothing goes over the network. Repos are not copied if the host config
+    points to the local checkout; otherwise they are rsynced locally.
+
+    """
+
+    def __init__(self, max_size_mb=RSYNC_MAX_SIZE_MB):
+        self.max_size_mb = max_size_mb
+        self.lock = threading.Lock()
+
+    def run(self, host, cmd, timeout=None):
+        return execute_and_return(cmd, timeout=timeout)
+
+    def popen(self, host, cmd, **kwargs):
+        return subprocess.Popen(shlex.split(cmd), **kwargs)
+
+    def stream(self, host, script, out_path, err_path):
+        return stream_script('bash -l -s', script, out_path, err_path)
+
+    def sync(self, host, repo_local, repo_remote):
+        target = join(repo_remote, os.path.basename(os.path.normpath(repo_local)))
+        if os.path.realpath(target) == os.path.realpath(repo_local): return True
+        with self.lock:
+            print('Performing local rsync of {0} to {1}...'.format(repo_local, repo_remote))
+            rsync = 'rsync --update -ra --max-size={0}m {1} {2}/'.format(self.max_size_mb, repo_local, repo_remote)
+            return execute_blocking(rsync) == 0
+
+
+class HostHealth(object):
+
+    """Circuit breaker with exponential back-off for a single host.
+
+    A closed breaker lets every poll through. A failed poll opens it for
+    backoff seconds, which doubles with every further failure up to
+    max_backoff. After the back-off a single probe is let through
+    (half open); its success closes the breaker again.
+
+    """
+
+    def __init__(self, backoff=HOST_BACKOFF_SECONDS, max_backoff=HOST_MAX_BACKOFF_SECONDS):
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = CircuitState.closed
+        self.failures = 0
+        self.retry_at = 0
+        self.reported = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Checks if the host may be contacted now."""
+        with self.lock:
+            if self.state == CircuitState.closed: return True
+            if self.state == CircuitState.open and time.time() >= self.retry_at:
+                self.state = CircuitState.half_open
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = CircuitState.closed
+            self.failures = 0
+            self.reported = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.retry_at = time.time() + min(self.backoff*2**(self.failures-1), self.max_backoff)
+            self.state = CircuitState.open
+
+    def report(self):
+        """True only the first time it is called after the host went down."""
+        with self.lock:
+            reported = self.reported
+            self.reported = True
+            return not reported
+
+
+class ClusterState(object):
+
+    """Cache bookkeeping for the GPU state of the hosts in host2config.
+
+    Every host has a time to live (ttl by default, see set_ttl). A host is
+    stale once its ttl has passed since its last refresh or after it was
+    invalidated, e.g. because a job was dispatched to it. Only stale hosts
+    need to be polled again.
+
+    """
+
+    def __init__(self, ttl=CLUSTER_STATE_TTL_SECONDS):
+        self.ttl = ttl
+        self.host2ttl = {}
+        self.refreshed = {}
+        self.lock = threading.Lock()
+
+    def set_ttl(self, host, ttl):
+        self.host2ttl[host] = ttl
+
+    def mark_fresh(self, host):
+        with self.lock:
+            self.refreshed[host] = time.time()
+
+    def invalidate(self, host):
+        with self.lock:
+            self.refreshed.pop(host, None)
+
+    def stale(self, hosts):
+        """Filters hosts down to the ones whose state needs to be refreshed."""
+        now = time.time()
+        with self.lock:
+            return [host for host in hosts if now - self.refreshed.get(host, 0) > self.host2ttl.get(host, self.ttl)]
+
+
+class ClusterTable(object):
+
+    """Struct-of-arrays copy of the per-GPU state of all hosts.
+
+    Every GPU is one row; the columns are NumPy arrays (host index, device
+    id, performance class, fp16, memory, utilization, status). Hosts have
+    their own arrays for priority, availability and the number of GPUs
+    that may be used after min free. SshScheduler updates the rows of a
+    host whenever its state changes, so selecting GPUs only needs masks
+    and sorts over the arrays instead of a walk over all hosts.
+
+    """
+
+    def __init__(self, hosts, priorities):
+        self.hosts = list(hosts)
+        self.host2idx = dict((host, i) for i, host in enumerate(self.hosts))
+        self.host_priority = np.array(priorities, dtype=np.int64)
+        self.host_available = np.zeros(len(self.hosts), dtype=bool)
+        self.num_available = np.zeros(len(self.hosts), dtype=np.int64)
+
+        self.host = np.zeros(0, dtype=np.int64)
+        self.device = np.zeros(0, dtype=np.int64)
+        self.performance = np.zeros(0, dtype=np.int64)
+        self.fp16 = np.zeros(0, dtype=bool)
+        self.free_mem = np.zeros(0, dtype=np.int64)
+        self.utilization = np.zeros(0, dtype=np.int64)
+        self.available = np.zeros(0, dtype=bool)
+
+    def update_host(self, host, config):
+        """Copies the state of a host in host2config into the table."""
+        i = self.host2idx[host]
+        self.host_available[i] = config['status'] == HostState.available
+        self.num_available[i] = config.get('num_available', 0)
+        gpus = config.get('gpus', [])
+        rows = np.flatnonzero(self.host == i)
+        if len(rows) != len(gpus):
+            keep = self.host != i
+            columns = {}
+            columns['host'] = [i]*len(gpus)
+            columns['device'] = [gpu['device_id'] for gpu in gpus]
+            columns['performance'] = [gpu['performance'] for gpu in gpus]
+            columns['fp16'] = [gpu['fp16'] for gpu in gpus]
+            columns['free_mem'] = [gpu['free_mem'] for gpu in gpus]
+            columns['utilization'] = [gpu['utilization'] for gpu in gpus]
+            columns['available'] = [gpu['status'] == GPUStatus.available for gpu in gpus]
+            for name, values in columns.items():
+                column = getattr(self, name)
+                setattr(self, name, np.concatenate([column[keep], np.array(values, dtype=column.dtype)]))
+            return
+        for row, gpu in zip(rows, gpus):
+            self.device[row] = gpu['device_id']
+            self.performance[row] = gpu['performance']
+            self.fp16[row] = gpu['fp16']
+            self.free_mem[row] = gpu['free_mem']
+            self.utilization[row] = gpu['utilization']
+            self.available[row] = gpu['status'] == GPUStatus.available
+
+    def priority_order(self):
+        """Gets the rows of the GPUs to use, best first.
+
+        Hosts are ordered by priority (ties by their order in hosts.txt) and
+        the GPUs of a host by performance and then device id, both
+        descending. Only available GPUs on available hosts are returned and
+        at most num_available of them per host.
+
+        """
+        rows = np.flatnonzero(self.available & self.host_available[self.host])
+        if len(rows) == 0: return rows
+        host = self.host[rows]
+        order = np.lexsort((-self.device[rows], -self.performance[rows], host, -self.host_priority[host]))
+        rows, host = rows[order], host[order]
+        # rank of every GPU within its host; the rows of a host are contiguous after the sort
+        starts = np.flatnonzero(np.r_[True, host[1:] != host[:-1]])
+        first = np.repeat(starts, np.diff(np.r_[starts, len(host)]))
+        rank = np.arange(len(host)) - first
+        return rows[rank < self.num_available[host]]
+
+    def count_available(self):
+        """Gets the number of usable GPUs and usable fp16 GPUs per host."""
+        mask = self.available & self.host_available[self.host]
+        fp16 = np.bincount(self.host[mask & self.fp16], minlength=len(self.hosts))
+        total = np.where(self.host_available, self.num_available, 0)
+        return total, np.minimum(total, fp16)
+
+
+class JobStore(object):
+
+    """Crash-safe record of SshScheduler jobs in SQLite (WAL mode).
+
+    Every job is stored with its state, host and device under an id which
+    is derived from its path, repo, work dir and command, so the same grid
+    maps to the same rows when its script is run again. Inserts and state
+    updates are buffered and written in batches; flush() writes them out.
+
+    """
+
+    def __init__(self, path, batch_size=JOB_STORE_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.inserts = []
+        self.updates = []
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, job TEXT, state INTEGER, host TEXT, device TEXT, updated REAL)')
+        self.db.commit()
+
+    @staticmethod
+    def job_id(job):
+        key = json.dumps([job['path'], job['repo_dir'], job['work_dir'], job['cmd']])
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def add(self, job):
+        """Adds a queued job. Jobs which are already in the store are kept as they are."""
+        data = dict(job)
+        if data.get('deadline') is not None: data['deadline'] = data['deadline'].timestamp()
+        data['after'] = [parent['id'] for parent in job.get('after', [])]
+        with self.lock:
+            self.inserts.append((job['id'], json.dumps(data), JobState.queued.value, time.time()))
+            full = len(self.inserts) >= self.batch_size
+        if full: self.flush()
+
+    def update(self, job, state, host=None, device=None):
+        with self.lock:
+            self.updates.append((state.value, host, None if device is None else str(device), time.time(), job['id']))
+            full = len(self.updates) >= self.batch_size
+        if full: self.flush()
+
+    def flush(self):
+        with self.lock:
+            if len(self.inserts) == 0 and len(self.updates) == 0: return
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO jobs (id, job, state, updated) VALUES (?, ?, ?, ?)', self.inserts)
+                self.db.executemany('UPDATE jobs SET state=?, host=COALESCE(?, host), device=COALESCE(?, device), updated=? WHERE id=?', self.updates)
+            self.inserts = []
+            self.updates = []
+
+    def states(self):
+        """Gets a dictionary of job id to JobState."""
+        self.flush()
+        with self.lock:
+            return dict((job_id, JobState(state)) for job_id, state in self.db.execute('SELECT id, state FROM jobs'))
+
+    def load(self, states):
+        """Loads all jobs which are in one of the given states."""
+        self.flush()
+        values = [state.value for state in states]
+        with self.lock:
+            rows = self.db.execute('SELECT job FROM jobs WHERE state IN ({0})'.format(','.join('?'*len(values))), values).fetchall()
+        jobs = []
+        for (data,) in rows:
+            job = json.loads(data)
+            if job.get('deadline') is not None: job['deadline'] = datetime.datetime.fromtimestamp(job['deadline'])
+            jobs.append(job)
+        return jobs
+
+    def summary(self):
+        counts = dict((state.name, 0) for state in JobState)
+        for state in self.states().values():
+            counts[state.name] += 1
+        return counts
+
+
+class CompletionIndex(object):
+
+    """Index of the commands which finished successfully, keyed by command_hash.
+
+    The index is a folder with one empty file per finished command, so
+    running jobs can add themselves to it (see completion_suffix). A
+    command which is not in the index yet counts as finished if its
+    checkpoint folder (--save-dir) has a COMPLETION_FILE or if one of the
+    logs in its log folder ends with its COMPLETION_LINE. Commands found
+    there are added to the index.
+
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.exists(folder): os.makedirs(folder)
+        self.hashes = set(os.listdir(folder))
+        self.scanned = set()
+
+    def mark(self, key):
+        if key in self.hashes: return
+        open(join(self.folder, key), 'w').close()
+        self.hashes.add(key)
+
+    def scan_logs(self, log_folder):
+        """Adds the commands of all finished logs in log_folder. Each folder is only scanned once."""
+        if log_folder in self.scanned or not os.path.exists(log_folder): return
+        self.scanned.add(log_folder)
+        pattern = re.compile(COMPLETION_LINE.format('([0-9a-f]{32})'))
+        for name in os.listdir(log_folder):
+            if not name.endswith('.log'): continue
+            for key in pattern.findall(read_tail(join(log_folder, name))):
+                self.mark(key)
+
+    def done(self, cmds, log_folder=None, work_dir=None):
+        """Checks if a command (or list of commands) finished successfully before.
+
+        :work_dir: The folder in which the command runs. A relative
+                   --save-dir is only checked if it is given.
+
+        """
+        key = command_hash(cmds)
+        if key in self.hashes: return True
+        folder = save_dir(cmds)
+        if folder is not None and not os.path.isabs(folder):
+            folder = None if work_dir is None else join(work_dir, folder)
+        if folder is not None and os.path.exists(join(folder, COMPLETION_FILE)):
+            self.mark(key)
+        elif log_folder is not None:
+            self.scan_logs(log_folder)
+        return key in self.hashes
+
+
+def write_manifest(path, entries):
+    """Writes entries as JSON lines which are all padded to the same width.
+
+    The entry with index i starts at byte i*width, so a single entry can be
+    read with one seek, e.g. by an array task or restart_failed.py.
+
+    :entries: List of JSON serializable dictionaries.
+    :returns: The width of a line in bytes, including the newline.
+
+    """
+    lines = [json.dumps(entry) for entry in entries]
+    width = max(len(line) for line in lines) + 1
+    with open(path, 'w') as f:
+        f.write(''.join(line.ljust(width - 1) + '\n' for line in lines))
+    return width
+
+def command_hash(cmds):
+    """Gets the md5 hash of the command (or list of commands) of a job."""
+    if isinstance(cmds, list): cmds = '\n'.join(cmds)
+    return hashlib.md5(str(cmds).encode('utf-8')).hexdigest()
+
+def save_dir(cmds):
+    """Gets the checkpoint folder (--save-dir) of a command or None. Quoted folders are not supported."""
+    if isinstance(cmds, list): cmds = '\n'.join(cmds)
+    match = re.search(r'--save-dir[ =]([^\s\'"]+)(?:\s|$)', cmds)
+    return None if match is None else match.group(1)
+
+def completion_suffix(cmds, index_folder=None, key=None):
+    """Gets the shell code which is appended to the last command of a job.
+
+    Once the command succeeded, it prints the COMPLETION_LINE of the job
+    and marks its checkpoint folder and index_folder (see CompletionIndex).
+    The markers never change the exit code of the job: a failed command
+    keeps its exit code and a marker which cannot be written is ignored.
+
+    :key: The command_hash of the job, if cmds were changed since.
+
+    """
+    key = command_hash(cmds) if key is None else key
+    marks = ['echo "{0}"'.format(COMPLETION_LINE.format(key))]
+    folder = save_dir(cmds)
+    if folder is not None:
+        marks.append('touch {0} 2>/dev/null'.format(join(folder, COMPLETION_FILE)))
+    if index_folder is not None:
+        marks.append('touch {0} 2>/dev/null'.format(join(index_folder, key)))
+    marks.append('true')
+    return ' && {{ {0}; }}'.format('; '.join(marks))
+
+def parse_nvidia_smi_topo(text):
+    """Parses the connection matrix of nvidia-smi topo -m.
+
+    :text: The output of nvidia-smi topo -m.
+    :returns: Dictionary (gpu_a, gpu_b) -> link type, e.g. NV2, PIX or SYS.
+
+    """
+    text = re.sub(r'\x1b\[[0-9;]*m', '', text)
+    links = {}
+    num_gpus = 0
+    for line in text.split('\n'):
+        values = line.split()
+        if len(values) == 0: continue
+        if num_gpus == 0 and values[0] == 'GPU0':
+            num_gpus = len([value for value in values if re.match(r'^GPU\d+$', value)])
+            continue
+        if num_gpus > 0 and re.match(r'^GPU\d+$', values[0]):
+            a = int(values[0][3:])
+            for b, link in enumerate(values[1:num_gpus+1]):
+                if a != b: links[(a, b)] = link
+    return links
+
+def topology_cost(link):
+    """Cost of a link type of nvidia-smi topo -m. NVLink is the cheapest."""
+    if link.startswith('NV'):
+        return 10 - min(int(link[2:]), 9)
+    return TOPOLOGY_LINK_COST.get(link, 50)
+
+def parse_nvidia_smi_xml(text):
+    """Parses the output of nvidia-smi -q -x.
+
+    Streams through the XML and only keeps the fields which the scheduler
+    uses. Each <gpu> element is discarded as soon as it is parsed.
+
+    :text: The XML output of nvidia-smi.
+    :returns: List of dictionaries with name, device_id, utilization,
+              total_mem, used_mem and free_mem for each GPU.
+
+    """
+    gpus = []
+    gpu = None
+    tags = []
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    parser.feed(text)
+    for event, elem in parser.read_events():
+        if event == 'start':
+            tags.append(elem.tag)
+            if elem.tag == 'gpu': gpu = {}
+            continue
+        tags.pop()
+        if gpu is None: continue
+        if elem.tag == 'gpu':
+            gpus.append(gpu)
+            gpu = None
+            elem.clear()
+        elif elem.tag == 'product_name':
+            gpu['name'] = elem.text
+        elif elem.tag == 'minor_number':
+            gpu['device_id'] = int(elem.text)
+        elif elem.tag == 'gpu_util' and tags[-1] == 'utilization':
+            gpu['utilization'] = int(elem.text.split()[0])
+        elif tags[-1] == 'fb_memory_usage' and elem.tag in ['total', 'used', 'free']:
+            gpu['{0}_mem'.format(elem.tag)] = int(elem.text.split()[0])
+    parser.close()
+    return gpus
+
+def parse_nvidia_smi_csv(text):
+    """Parses the output of NVIDIA_SMI_QUERIES['csv'].
+
+    Note that the csv query reports the nvidia-smi index of a GPU and not
+    its minor number as the XML output does.
+
+    :text: Lines of name, index, utilization.gpu, memory.total, memory.used, memory.free.
+    :returns: Same as parse_nvidia_smi_xml.
+
+    """
+    gpus = []
+    for line in text.strip().split('\n'):
+        if len(line.strip()) == 0: continue
+        name, device_id, utilization, total, used, free = [value.strip() for value in line.rsplit(',', 5)]
+        gpu = {}
+        gpu['name'] = name
+        gpu['device_id'] = int(device_id)
+        gpu['utilization'] = int(utilization)
+        gpu['total_mem'] = int(total)
+        gpu['used_mem'] = int(used)
+        gpu['free_mem'] = int(free)
+        gpus.append(gpu)
+    return gpus
+
 gpu_name2fp16 = {}
 gpu_name2fp16['TITAN V'] = True
 gpu_name2fp16['GeForce RTX 2080 Ti'] = True
@@ -66,10 +813,52 @@ gpu_name2performance_class['GeForce GTX TITAN X'] = 3
 gpu_name2performance_class['GeForce GTX 1080 Ti'] = 3
 
 
+class TelemetryListener(threading.Thread):
+
+    """Runs the telemetry agent on a host and feeds its updates to the scheduler."""
+
+    def __init__(self, scheduler, host, interval_ms=AGENT_INTERVAL_MS):
+        super(TelemetryListener, self).__init__()
+        self.daemon = True
+        self.scheduler = scheduler
+        self.host = host
+        self.interval_ms = interval_ms
+        self.proc = None
+        self.last_message = 0
+
+    def is_live(self):
+        """True if the agent sent a message within AGENT_TIMEOUT_SECONDS."""
+        return self.is_alive() and time.time() - self.last_message < AGENT_TIMEOUT_SECONDS
+
+    def run(self):
+        with open(join(os.path.dirname(os.path.abspath(__file__)), 'agent.py')) as f:
+            source = f.read()
+        strCMD = '{0} -u - --interval-ms {1}'.format(AGENT_PYTHON, self.interval_ms)
+        self.proc = self.scheduler.executor(self.host).popen(self.host, strCMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                             stderr=subprocess.DEVNULL, universal_newlines=True)
+        try:
+            self.proc.stdin.write(source)
+            self.proc.stdin.close()
+            for line in self.proc.stdout:
+                self.last_message = time.time()
+                self.scheduler.apply_telemetry(self.host, json.loads(line))
+        except (BrokenPipeError, ValueError) as e:
+            if self.scheduler.verbose:
+                print('Telemetry agent on host {0} failed: {1}'.format(self.host, e))
+        self.last_message = 0
+        self.proc.wait()
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+
+
 class GPUWorker(threading.Thread):
-    def __init__(self, scheduler, local_config, config_folder, logdir, host_name, host_config, device_id, job, idx, cmds):
+    def __init__(self, scheduler, local_config, config_folder, logdir, host_name, host_config, device_id, job, idx, cmds, slots=[]):
         super(GPUWorker, self).__init__()
         self.scheduler = scheduler
+        self.slots = slots
+        self.success = False
         self.isDaemon = False
         self.job = job
         self.idx = idx
@@ -82,81 +871,86 @@ class GPUWorker(threading.Thread):
         self.additional_cmds = cmds
         self.local_config = local_config
 
-    def construct_init_file(self):
-        if not os.path.exists('/tmp/gpuscheduler'): os.mkdir('/tmp/gpuscheduler')
-        if not os.path.exists(join('/tmp/gpuscheduler', str(self.idx))): os.mkdir(join('/tmp/gpuscheduler', str(self.idx)))
+    def render_init_script(self):
+        """Renders the script which sets up the environment and runs the job.
 
-        print('{0}: Constructing init file...'.format(self.prefix))
-        init_path = join('/tmp/gpuscheduler/', str(self.idx), 'init_{0}.sh'.format(self.idx))
-        shutil.copyfile(join(self.init_dir, 'init.sh'), init_path)
+        The script is kept in memory and piped to the remote shell, so no
+        files are written locally or copied to the host.
+
+        """
+        with open(join(self.init_dir, 'init.sh')) as f:
+            init = f.read()
         if self.cfg['conda_path'] != 'anaconda3':
-            new_env = "sed -i 's/anaconda3/{0}/g' {1}".format(self.cfg['conda_path'], init_path)
-            print('{0}: Executing change in conda path variable...'.format(self.prefix))
-            execute(new_env)
+            init = init.replace('anaconda3', self.cfg['conda_path'])
 
         work_dir_remote = join(self.cfg['GIT_HOME'], self.job['work_dir'])
+        lines = [init.rstrip('\n')]
+        lines.append('export GIT_HOME={0}'.format(self.cfg['GIT_HOME']))
+        lines.append('cd {0}'.format(work_dir_remote))
+        if self.cfg['conda_env'] != 'base':
+            lines.append('source activate {0}'.format(self.cfg['conda_env']))
+        for cmd in self.additional_cmds:
+            lines.append(cmd)
+        suffix = completion_suffix(self.job['cmd'], key=self.job.get('cmd_hash'))
+        lines.append('CUDA_VISIBLE_DEVICES={0} {1}{2}'.format(self.device_id, self.job['cmd'], suffix))
+        return '\n'.join(lines) + '\n'
+
+    def sync_repo(self):
         repo_local = join(self.local_config['GIT_HOME'], self.job['repo_dir'])
         repo_remote = join(self.cfg['GIT_HOME'])
-
-        with open(init_path, 'a') as f:
-            f.write('export GIT_HOME={0}\n'.format(self.cfg['GIT_HOME']))
-            f.write('cd {0}\n'.format(work_dir_remote))
-            if self.cfg['conda_env'] != 'base':
-                f.write('source activate {0}\n'.format(self.cfg['conda_env']))
-            for cmd in self.additional_cmds:
-                f.write('{0}\n'.format(cmd))
-            f.write('CUDA_VISIBLE_DEVICES={0} {1}\n'.format(self.device_id, self.job['cmd']))
-        time.sleep(1)
-        cmd = 'scp {0} {1}:~/'.format(init_path, self.host_name)
-        print('{0}: Transfering init file...'.format(self.prefix))
-        execute(cmd)
-
-        print('Performing rsync...')
-        rsync = 'rsync --update -raz --progress --max-size=10m {0} {1}:{2}/'.format(repo_local, self.host_name, repo_remote)
-        execute_blocking(rsync)
-
-        time.sleep(2)
+        return self.scheduler.executor(self.host_name).sync(self.host_name, repo_local, repo_remote)
 
 
     def create_log_path(self, path):
-        path = os.path.normpath(path)
-        paths = path.split(os.sep)
-        full_path = self.logdir
-        for p in paths:
-            full_path = join(full_path, p)
-            if not os.path.exists(full_path): os.mkdir(full_path)
+        # workers start at the same time, so another one may create the folder first
+        os.makedirs(join(self.logdir, os.path.normpath(path)), exist_ok=True)
 
 
     def run(self):
-        if not os.path.exists(self.logdir): os.mkdir(self.logdir)
-        if not os.path.exists(join(self.logdir, 'errors')): os.mkdir(join(self.logdir, 'errors'))
+        try:
+            self.execute_job()
+        finally:
+            self.scheduler.worker_done(self)
+
+    def execute_job(self):
+        os.makedirs(join(self.logdir, 'errors'), exist_ok=True)
         print('Started worker {0} on Host {1} for GPU {2}'.format(self.idx, self.host_name, self.device_id))
-        self.construct_init_file()
-        print('Executing on {0}:{1}...'.format(self.host_name, self.device_id))
-        out, err = cmd_over_ssh(self.host_name, 'init_{0}.sh'.format(self.idx))
-        log_name = str(uuid.uuid4()) + '.log'
-        if len(err) > 0 and 'warning' not in err.lower():
-            print('{1}: ERROR: {0}'.format(err, self.prefix))
-            err_file_path = join(self.logdir, 'errors', log_name)
-            with open(err_file_path, 'w') as f:
-                f.write(out)
+        script = self.render_init_script()
+        self.sync_repo()
 
+        log_name = str(uuid.uuid4())
         path = self.job['path']
         self.create_log_path(path)
-        file_path = join(self.logdir, path, log_name)
-        with open(file_path, 'w') as f:
-            f.write(out)
-
-        if len(err) > 0 and not 'warning' in err.lower():
-            print('{0}: Finish task with errors! Writing stdout data to {1} and error to {2}...'.format(self.prefix, file_path, err_file_path))
+        file_path = join(self.logdir, path, log_name + '.log')
+        err_path = join(self.logdir, path, log_name + '.err')
+        print('Executing on {0}:{1}. Streaming output to {2}...'.format(self.host_name, self.device_id, file_path))
+        self.scheduler.job_started(self.job)
+        returncode = self.scheduler.executor(self.host_name).stream(self.host_name, script, file_path, err_path)
+        err = read_tail(err_path)
+
+        if returncode != 0 or (len(err) > 0 and 'warning' not in err.lower()):
+            print('{1}: ERROR: {0}'.format(err, self.prefix))
+            err_file_path = join(self.logdir, 'errors', log_name + '.log')
+            with open(err_file_path, 'w') as f:
+                f.write(err)
+            print('{0}: Finish task with errors! Stdout is in {1} and stderr in {2}...'.format(self.prefix, file_path, err_path))
         else:
-            print('{0}: Finish task successfully! Writing data to {1}...'.format(self.prefix, file_path))
+            self.success = True
+            print('{0}: Finish task successfully! Stdout is in {1}...'.format(self.prefix, file_path))
 
 
 class HyakScheduler(object):
-    def __init__(self, config_folder='./config', verbose=False, account='cse', partition='cse-gpu', use_gres=False):
+    def __init__(self, config_folder='./config', verbose=False, account='cse', partition='cse-gpu', use_gres=False,
+                 submit_workers=SUBMIT_WORKERS, submit_retries=SUBMIT_RETRIES):
         self.jobs = []
         self.verbose = verbose
+        self.submit_workers = submit_workers
+        self.submit_retries = submit_retries
+        self.submit_lock = threading.Lock()
+        self.submit_stats = {}
+        self.failed_submissions = []
+        self.index = None
+        self.num_done = 0
         self.config = {}
         self.remap = {}
         self.init_with_config(config_folder)
@@ -175,28 +969,376 @@ class HyakScheduler(object):
 
 
 
-    def add_job(self, path, repo_dir, work_dir, cmds, time_hours, fp16=False, gpus=1, mem=32, cores=6, constraint='', exclude='', time_minutes=0):
-        self.jobs.append([path, work_dir, cmds, time_hours, fp16, gpus, mem, cores, constraint, exclude, time_minutes])
+    def completion_index(self):
+        """Gets the CompletionIndex in COMPLETION_INDEX (default: SCRIPT_HISTORY/completed)."""
+        if self.index is None:
+            self.index = CompletionIndex(self.config.get('COMPLETION_INDEX', join(self.config['SCRIPT_HISTORY'], 'completed')))
+        return self.index
+
+    def add_job(self, path, repo_dir, work_dir, cmds, time_hours, fp16=False, gpus=1, mem=32, cores=6, constraint='', exclude='', time_minutes=0, after=[],
+                skip_if_done=False):
+        """Adds a job to submit with run_jobs.
+
+        :after: Handles (returned by add_job) of jobs which must finish
+                successfully before this job starts.
+        :skip_if_done: Does not submit the job if its commands finished
+                       successfully before, see CompletionIndex. Jobs
+                       which depend on it do not wait for it.
+        :returns: A handle of the job.
+
+        """
+        job = {}
+        job['path'] = path
+        job['repo_dir'] = repo_dir
+        job['work_dir'] = work_dir
+        job['cmds'] = cmds
+        job['time_hours'] = time_hours
+        job['time_minutes'] = time_minutes
+        job['fp16'] = fp16
+        job['gpus'] = gpus
+        job['mem'] = mem
+        job['cores'] = cores
+        job['constraint'] = constraint
+        job['exclude'] = exclude
+        job['after'] = [parent for parent in after if not parent.get('done')]
+        if skip_if_done and self.completion_index().done(cmds, join(self.config['LOG_HOME'], path), join(self.config['GIT_HOME'], work_dir)):
+            job['done'] = True
+            self.num_done += 1
+            return job
+        self.jobs.append(job)
         if self.verbose:
             print('#SBATCH --time={0:02d}:{1:02d}:00'.format(time_hours, time_minutes))
+        return job
 
-    def run_jobs(self, as_array=True, sleep_delay_seconds=0, single_process=False, log_id=None, skip_cmds=0, comment=None, begin=None):
+    def dependency_stages(self, jobs):
+        """Splits jobs into stages so that every job comes after the stages of its parents.
 
-        array_preamble = []
+        Parents which are not in jobs were submitted by an earlier run_jobs.
+
+        """
+        job2stage = {}
+        def stage_of(job):
+            if id(job) not in job2stage:
+                parents = [parent for parent in job['after'] if 'slurm_id' not in parent]
+                job2stage[id(job)] = 1 + max([stage_of(parent) for parent in parents]) if len(parents) > 0 else 0
+            return job2stage[id(job)]
+        stages = []
+        for job in jobs:
+            stage = stage_of(job)
+            while len(stages) <= stage: stages.append([])
+            stages[stage].append(job)
+        return stages
+
+    def dependency(self, jobs):
+        """Gets the sbatch --dependency value for a job or an array of jobs.
+
+        If task i of the array only depends on task i of one earlier array,
+        every task waits just for its own parent (aftercorr). Otherwise the
+        jobs wait for all of their parents (afterok).
+
+        """
+        parents = [parent for job in jobs for parent in job['after']]
+        if len(parents) == 0: return None
+        if len(jobs) > 1 and all(len(job['after']) == 1 for job in jobs):
+            array_ids = set(job['after'][0]['job_id'] for job in jobs)
+            if len(array_ids) == 1 and all(job['after'][0]['task_id'] == i for i, job in enumerate(jobs)):
+                return 'aftercorr:{0}'.format(array_ids.pop())
+        slurm_ids = []
+        for parent in parents:
+            if parent['slurm_id'] not in slurm_ids: slurm_ids.append(parent['slurm_id'])
+        return 'afterok:' + ':'.join(slurm_ids)
+
+    def sbatch(self, script_file, dependency=None):
+        """Submits a script.
+
+        Submissions which fail with one of SBATCH_RETRY_ERRORS (the
+        controller is busy or the user has too many jobs queued) are
+        retried up to submit_retries times with exponential back-off.
+
+        :returns: The Slurm job id or None if the submission failed.
+
+        """
+        strCMD = 'sbatch'
+        if dependency is not None:
+            strCMD += ' --dependency={0} --kill-on-invalid-dep=yes'.format(dependency)
+        backoff = SUBMIT_BACKOFF_SECONDS
+        for attempt in range(self.submit_retries + 1):
+            out, err = execute_and_return('{0} {1}'.format(strCMD, script_file))
+            match = re.search(r'Submitted batch job (\d+)', out)
+            if match is not None:
+                self.count_submission('submitted')
+                return match.group(1)
+            if attempt == self.submit_retries or not any(error in err for error in SBATCH_RETRY_ERRORS): break
+            print('Submitting {0} failed: {1}. Retrying in {2}s...'.format(script_file, err, backoff))
+            self.count_submission('retried')
+            time.sleep(backoff)
+            backoff = min(backoff*2, SUBMIT_MAX_BACKOFF_SECONDS)
+        print('Submitting {0} failed: {1}'.format(script_file, err))
+        self.count_submission('failed')
+        with self.submit_lock:
+            self.failed_submissions.append(script_file)
+        return None
 
+    def count_submission(self, outcome):
+        with self.submit_lock:
+            self.submit_stats[outcome] = self.submit_stats.get(outcome, 0) + 1
 
-        strval = self.jobs[0][2]
+    def print_submit_stats(self):
+        stats = self.submit_stats
+        print('Submitted {0} Slurm jobs. Failed: {1}. Retries: {2}.'.format(stats.get('submitted', 0), stats.get('failed', 0), stats.get('retried', 0)))
+        for script_file in self.failed_submissions:
+            print('Not submitted: {0}'.format(script_file))
+
+    def slurm_limits(self):
+        """Gets MaxArraySize of the cluster and the MaxSubmit limit of the user.
+
+        MaxArraySize comes from scontrol show config and MaxSubmit from the
+        associations of the user in sacctmgr. Limits which are not set or
+        cannot be queried are None.
+
+        """
+        max_array_size, max_submit = None, None
+        out = execute('scontrol show config')
+        match = None if out is None else re.search(r'MaxArraySize\s*=\s*(\d+)', out)
+        if match is not None:
+            max_array_size = int(match.group(1))
+        out = execute('sacctmgr -nP show assoc user=$USER format=MaxSubmit')
+        values = [] if out is None else [int(value) for value in out.split() if value.isdigit()]
+        if len(values) > 0:
+            max_submit = min(values)
+        return max_array_size, max_submit
+
+    def count_queued(self):
+        """Gets the number of pending and running jobs of the user, counting every array task."""
+        out = execute('squeue -h -r -u $USER -o %i')
+        return 0 if out is None else len(out.split())
+
+    def wait_for_capacity(self, num_jobs, max_submit, poll_seconds=SUBMIT_POLL_SECONDS):
+        """Blocks until some of num_jobs more jobs fit into the queue of the user.
+
+        To not submit lots of tiny arrays, it waits until a tenth of
+        max_submit (or all num_jobs) fit.
+
+        :returns: The number of jobs which fit into the queue now.
+
+        """
+        min_room = min(num_jobs, max(1, max_submit // 10))
+        while True:
+            queued = self.count_queued()
+            if max_submit - queued >= min_room: return min(num_jobs, max_submit - queued)
+            print('{0} jobs are queued. Waiting until {1} more fit under MaxSubmit={2}...'.format(queued, min_room, max_submit))
+            time.sleep(poll_seconds)
+
+    def run_jobs(self, as_array=True, sleep_delay_seconds=0, single_process=False, log_id=None, skip_cmds=0, comment=None, begin=None, manifest=False,
+                 array_throttle=None, max_array_size=None, max_submit=None, submit_poll_seconds=SUBMIT_POLL_SECONDS, pack=1, pack_size=None):
+        """Submits all jobs which were not submitted yet.
+
+        Jobs which depend on other jobs of the same call (after=... in
+        add_job) are submitted in later stages, one array per stage, with a
+        Slurm dependency on the job ids of their parents. Jobs whose parents
+        could not be submitted are skipped.
+
+        Arrays larger than MaxArraySize or than the room which is left in
+        the queue of the user under MaxSubmit are split into chunks <id>_c0,
+        <id>_c1, ... Each chunk is sized to the room which is free when it
+        is submitted, so the jobs trickle onto the cluster as earlier ones
+        finish.
+
+        :manifest: With as_array, stores the scripts of all tasks in a single
+                   manifest_<id>.jsonl (see write_manifest) instead of two
+                   script files per task and a job list.
+        :array_throttle: With as_array, runs at most this many tasks of each
+                         array at the same time (--array=0-N%array_throttle).
+                         The limit holds per array: a grid which is split
+                         into several groups or chunks can run this many
+                         tasks of each of them.
+        :max_array_size: Overrides MaxArraySize of the cluster.
+        :max_submit: Overrides the MaxSubmit limit of the user.
+        :submit_poll_seconds: Seconds between queue checks while waiting
+                              for room for the next chunk.
+        :pack: Bundles single GPU jobs into allocations of pack GPUs, see
+               pack_jobs. Useful for many short jobs.
+        :pack_size: Number of jobs per bundle. Defaults to pack; larger
+                    bundles run their jobs in several rounds.
+
+        """
+        if self.num_done > 0:
+            print('Skipping {0} jobs which already finished.'.format(self.num_done))
+            self.num_done = 0
+        jobs = [job for job in self.jobs if 'slurm_id' not in job]
+        if len(jobs) == 0: return
+        # jobs add themselves to the index when they finish, so its folder has to exist
+        self.completion_index()
+        self.submit_stats = {}
+        self.failed_submissions = []
+
+        strval = jobs[0]['cmds']
         if not isinstance(strval, str): strval = strval[0]
         array_id = hashlib.md5(strval.encode('utf-8')).hexdigest() if log_id is None else log_id
 
+        if as_array and (max_array_size is None or max_submit is None):
+            limits = self.slurm_limits()
+            max_array_size = limits[0] if max_array_size is None else max_array_size
+            max_submit = limits[1] if max_submit is None else max_submit
+
+        for stage_no, stage in enumerate(self.dependency_stages(jobs)):
+            ready = [job for job in stage if all('slurm_id' in parent for parent in job['after'])]
+            if len(ready) < len(stage):
+                print('Skipping {0} jobs because some of their parent jobs were not submitted.'.format(len(stage) - len(ready)))
+            if len(ready) == 0: continue
+            stage_id = array_id if stage_no == 0 else '{0}_s{1}'.format(array_id, stage_no)
+            if pack > 1:
+                num_jobs = len(ready)
+                ready = self.pack_jobs(ready, pack, pack_size)
+                print('Packed {0} jobs into {1} Slurm jobs.'.format(num_jobs, len(ready)))
+            if not as_array:
+                self.submit_jobs(ready, stage_id, as_array, sleep_delay_seconds, single_process, skip_cmds, comment, begin, manifest)
+                continue
+            groups = self.group_jobs(ready)
+            if len(groups) > 1:
+                print('Submitting {0} jobs with {1} different resource requests as {1} arrays.'.format(len(ready), len(groups)))
+            for group_no, group in enumerate(groups):
+                group_id = stage_id if len(groups) == 1 else '{0}_g{1}'.format(stage_id, group_no)
+                remaining = group
+                chunk_no = 0
+                while len(remaining) > 0:
+                    chunk_size = len(remaining) if max_array_size is None else min(len(remaining), max_array_size)
+                    if max_submit is not None:
+                        chunk_size = self.wait_for_capacity(chunk_size, max_submit, submit_poll_seconds)
+                    chunk, remaining = remaining[:chunk_size], remaining[chunk_size:]
+                    chunk_id = group_id if chunk_no == 0 and len(remaining) == 0 else '{0}_c{1}'.format(group_id, chunk_no)
+                    if chunk_id != group_id:
+                        print('Submitting jobs {0}-{1} of {2} as array {3}.'.format(
+                            len(group) - len(remaining) - len(chunk), len(group) - len(remaining) - 1, len(group), chunk_id))
+                    self.submit_jobs(chunk, chunk_id, as_array, sleep_delay_seconds, single_process, skip_cmds, comment, begin, manifest, array_throttle)
+                    chunk_no += 1
+        self.print_submit_stats()
+
+    def group_jobs(self, jobs):
+        """Groups jobs by everything that goes into the header of an array.
+
+        An array requests the same resources, log folder and work dir for
+        all of its tasks, so only jobs with the same values can share one.
+        Bundles (see pack_jobs) are launched differently and never share an
+        array with other jobs.
+
+        :returns: List of groups in the order of their first job.
+
+        """
+        signature2group = OrderedDict()
+        for job in jobs:
+            signature = tuple(job[key] for key in ['path', 'work_dir', 'gpus', 'mem', 'cores', 'time_hours', 'time_minutes', 'constraint', 'exclude']) + ('bundle' in job,)
+            signature2group.setdefault(signature, []).append(job)
+        return list(signature2group.values())
+
+    def pack_jobs(self, jobs, pack, pack_size=None):
+        """Bundles single GPU jobs into jobs which run them on pack GPUs.
+
+        Only jobs with the same resource signature (see group_jobs) are
+        bundled. A bundle of pack_size jobs (default: pack) allocates pack
+        GPUs for the time of one job times the number of rounds it needs.
+        The jobs of a bundle run as srun --exclusive steps with one GPU
+        each; a slot which finishes its job takes the next one of the bundle.
+
+        :returns: The bundles and the jobs which were not bundled.
+
+        """
+        pack = min(pack, 8)
+        pack_size = pack if pack_size is None else max(pack_size, pack)
+        packed = []
+        for group in self.group_jobs(jobs):
+            if group[0]['gpus'] != 1:
+                packed.extend(group)
+                continue
+            for i in range(0, len(group), pack_size):
+                members = group[i:i+pack_size]
+                if len(members) == 1:
+                    packed.extend(members)
+                    continue
+                bundle = dict(members[0])
+                bundle['gpus'] = min(pack, len(members))
+                bundle['mem'] = members[0]['mem']*bundle['gpus']
+                rounds = -(-len(members) // bundle['gpus'])
+                minutes = (members[0]['time_hours']*60 + members[0]['time_minutes'])*rounds
+                bundle['time_hours'], bundle['time_minutes'] = minutes // 60, minutes % 60
+                bundle['after'] = [parent for member in members for parent in member['after']]
+                bundle['bundle'] = members
+                packed.append(bundle)
+        return packed
+
+    def bundle_commands(self, bundle, skip_cmds=0):
+        """Gets the commands which run the jobs of a bundle on its GPU slots."""
+        members = bundle['bundle']
+        gpu_flag = '--gres=gpu:1' if self.use_gres else '--gpus=1'
+        lines = []
+        lines.append('BUNDLE_DIR=$(mktemp -d)')
+        lines.append('echo 0 > $BUNDLE_DIR/next')
+        for i, member in enumerate(members):
+            lines.append('job_{0}() {{'.format(i))
+            lines.extend(self.job_commands(member, skip_cmds))
+            lines.append('}')
+        lines.append('run_slot() {')
+        lines.append('\twhile true; do')
+        # the counter is shared by all slots, so it is read and incremented under a lock
+        lines.append('\t\ti=$(flock $BUNDLE_DIR/next bash -c \'i=$(cat $0); echo $((i+1)) > $0; echo $i\' $BUNDLE_DIR/next)')
+        lines.append('\t\tif [[ $i -ge {0} ]]; then break; fi'.format(len(members)))
+        lines.append('\t\techo "Slot $1 runs bundle job $i"')
+        lines.append('\t\tsrun --exclusive --nodes=1 --ntasks=1 --cpus-per-task={0} {1} bash -c "$(declare -f job_$i); job_$i" || echo $i >> $BUNDLE_DIR/failed'.format(
+            bundle['cores'], gpu_flag))
+        lines.append('\tdone')
+        lines.append('}')
+        lines.append('for slot in $(seq 1 {0}); do run_slot $slot & done'.format(bundle['gpus']))
+        lines.append('wait')
+        lines.append('if [[ -s $BUNDLE_DIR/failed ]]; then echo "Failed bundle jobs: $(cat $BUNDLE_DIR/failed | tr \'\\n\' \' \')"; rm -rf $BUNDLE_DIR; exit 1; fi')
+        lines.append('rm -rf $BUNDLE_DIR')
+        return lines
+
+    def job_commands(self, job, skip_cmds=0, echo=False):
+        """Gets the commands of a job, optionally each one echoed before it runs."""
+        if 'bundle' in job: return self.bundle_commands(job, skip_cmds)
+        cmds = job['cmds'] if isinstance(job['cmds'], list) else [job['cmds']]
+        suffix = completion_suffix(job['cmds'], self.completion_index().folder)
+        lines = []
+        for i, cmd in enumerate(cmds):
+            if i < skip_cmds: continue
+            if echo:
+                lines.append('echo "cmd{0}"'.format(cmd))
+            lines.append(cmd + suffix if i == len(cmds) - 1 else cmd)
+        return lines
+
+    def bare_script(self, job, skip_cmds=0):
+        """Gets the lines of the script which an array task runs."""
+        bare_lines = []
+        bare_lines.append('#!/bin/bash')
+        bare_lines.append('#')
+        bare_lines.append('export PATH=$PATH:{0}'.format(join(self.config['ANACONDA_HOME'], 'bin')))
+        bare_lines.extend(self.job_commands(job, skip_cmds))
+        return bare_lines
+
+    def set_slurm_id(self, job, job_id, task_id=None):
+        """Records the Slurm id of a submitted job (and of the jobs in it if it is a bundle)."""
+        slurm_id = job_id if task_id is None else '{0}_{1}'.format(job_id, task_id)
+        for job in [job] + job.get('bundle', []):
+            job['slurm_id'], job['job_id'], job['task_id'] = slurm_id, job_id, task_id
+
+    def submit_jobs(self, jobs, array_id, as_array=True, sleep_delay_seconds=0, single_process=False, skip_cmds=0, comment=None, begin=None, manifest=False, array_throttle=None):
+
+        array_preamble = []
+        manifest = manifest and as_array
+
         array_file = join(self.config['SCRIPT_HISTORY'], 'array_init_{0}.sh'.format(array_id))
         array_job_list = join(self.config['SCRIPT_HISTORY'], 'array_jobs_{0}.sh'.format(array_id))
+        manifest_file = join(self.config['SCRIPT_HISTORY'], 'manifest_{0}.jsonl'.format(array_id))
         script_list = []
-        for i, (path, work_dir, cmds, time_hours, fp16, gpus, mem, cores, constraint, exclude, time_minutes) in enumerate(self.jobs):
+        script_files = []
+        entries = []
+        existing = set()
+        for i, job in enumerate(jobs):
+            path, work_dir, time_hours, time_minutes = job['path'], job['work_dir'], job['time_hours'], job['time_minutes']
+            gpus, mem, cores, constraint, exclude = job['gpus'], job['mem'], job['cores'], job['constraint'], job['exclude']
             nodes = gpus // 8
             nodes += 1 if (gpus % 8) > 0 else 0
             gpus = 8 if gpus > 8 else gpus
-            if not isinstance(cmds, list): cmds = [cmds]
             lines = []
             script_file = join(self.config['SCRIPT_HISTORY'], 'init_{0}_{1}.sh'.format(array_id, i))
 
@@ -210,7 +1352,7 @@ class HyakScheduler(object):
             lines.append('#SBATCH --partition={0}'.format(self.config['partition']))
             lines.append('#')
             lines.append('#SBATCH --nodes={0}'.format(nodes))
-            if single_process:
+            if single_process and 'bundle' not in job:
                 lines.append('#SBATCH --ntasks-per-node=1')
                 lines.append('#SBATCH --cpus-per-task={0}'.format(cores*gpus))
             else:
@@ -239,65 +1381,82 @@ class HyakScheduler(object):
             lines.append('#SBATCH --error={0}'.format(join(log_path, array_id + '_{0}.err'.format(i))))
             lines.append('')
             lines.append('export PATH=$PATH:{0}'.format(join(self.config['ANACONDA_HOME'], 'bin')))
-            for cmd_no, cmd in enumerate(cmds[skip_cmds:]):
-                lines.append('echo "cmd{0}"'.format(cmd))
-                lines.append(cmd)
+            commands = self.job_commands(job, skip_cmds, echo=True)
+            lines.extend(commands)
 
             if len(array_preamble) == 0:
-                array_preamble = copy.deepcopy(lines[:-(2*len(cmds[skip_cmds:]) + 1)])
-                array_preamble[2] = '#SBATCH --job-name={0}'.format(array_job_list)
+                array_preamble = copy.deepcopy(lines[:-(len(commands) + 1)])
+                array_preamble[2] = '#SBATCH --job-name={0}'.format(manifest_file if manifest else array_job_list)
                 array_preamble[-3] = '#SBATCH --output={0}'.format(join(log_path, array_id + '_%a.log'))
                 array_preamble[-2] = '#SBATCH --error={0}'.format(join(log_path, array_id + '_%a.err'))
-                array_preamble.append('#SBATCH --array=0-{0}'.format(len(self.jobs)-1))
+                array_range = '0-{0}'.format(len(jobs)-1)
+                if array_throttle is not None:
+                    array_range += '%{0}'.format(array_throttle)
+                array_preamble.append('#SBATCH --array={0}'.format(array_range))
                 array_preamble.append('')
                 array_preamble.append('export PATH=$PATH:{0}'.format(join(self.config['ANACONDA_HOME'], 'bin')))
 
-            if not os.path.exists(log_path):
-                print('Creating {0}'.format(log_path))
-                os.makedirs(log_path)
-
-            if not os.path.exists(self.config['SCRIPT_HISTORY']):
-                print('Creating {0}'.format(self.config['SCRIPT_HISTORY']))
-                os.makedirs(self.config['SCRIPT_HISTORY'])
+            # most jobs share their folders, so each one is only checked once
+            for folder in [log_path, self.config['SCRIPT_HISTORY']]:
+                if folder in existing: continue
+                if not os.path.exists(folder):
+                    print('Creating {0}'.format(folder))
+                    os.makedirs(folder)
+                existing.add(folder)
+
+            if manifest:
+                entry = {'path': script_file, 'script': '\n'.join(lines) + '\n'}
+                entry['bare'] = '\n'.join(self.bare_script(job, skip_cmds)) + '\n'
+                entries.append(entry)
+                continue
 
             with open(script_file, 'w') as f:
                 for line in lines:
                     f.write('{0}\n'.format(line))
 
             if not as_array:
-                time.sleep(0.05)
-                out, err = execute_and_return('sbatch {0}'.format(script_file))
-                if err != '':
-                    print(err)
+                script_files.append((job, script_file))
+
+        if not as_array:
+            def submit(item):
+                job, script_file = item
+                job_id = self.sbatch(script_file, self.dependency([job]))
+                if job_id is not None:
+                    self.set_slurm_id(job, job_id)
+            print('Submitting {0} jobs with {1} parallel sbatch calls...'.format(len(script_files), self.submit_workers))
+            with ThreadPoolExecutor(max_workers=self.submit_workers) as executor:
+                list(executor.map(submit, script_files))
 
         if as_array:
             array_lines = []
             array_lines.append('')
             array_lines.append('')
-            array_lines.append('echo $SLURM_ARRAY_JOB_ID_$SLURM_ARRAY_TASK_ID'.format(cmd_no))
-            for i, (path, work_dir, cmds, time_hours, fp16, gpus, mem, cores, constraint, exclude, time_minutes) in enumerate(self.jobs):
-                bare_script_file = join(self.config['SCRIPT_HISTORY'], 'init_bare_{0}_{1}.sh'.format(array_id, i))
-                bare_lines = []
-                bare_lines.append('#!/bin/bash')
-                bare_lines.append('#')
-                bare_lines.append('export PATH=$PATH:{0}'.format(join(self.config['ANACONDA_HOME'], 'bin')))
-                for cmd_no, cmd in enumerate(cmds[skip_cmds:]):
-                    bare_lines.append(cmd)
-                with open(bare_script_file, 'w') as f:
-                    for line in bare_lines:
-                        f.write('{0}\n'.format(line))
-
-                if i == 0:
-                    array_lines.append('if [[ $SLURM_ARRAY_TASK_ID -eq {0} ]]'.format(i))
-                    array_lines.append('then')
-                else:
-                    array_lines.append('elif [[ $SLURM_ARRAY_TASK_ID -eq {0} ]]'.format(i))
-                    array_lines.append('then')
-                if sleep_delay_seconds > 0:
-                    array_lines.append('\t sleep {0}'.format(i*sleep_delay_seconds))
-
-                array_lines.append('\t srun bash ' + bare_script_file)
-
+            array_lines.append('echo $SLURM_ARRAY_JOB_ID_$SLURM_ARRAY_TASK_ID')
+            if manifest:
+                print('Writing manifest to: {0}'.format(manifest_file))
+                width = write_manifest(manifest_file, entries)
+                # the entry of a task starts at byte task_id*width, so tail seeks straight to it
+                array_lines.append('ENTRY=$(tail -c +$((SLURM_ARRAY_TASK_ID*{0}+1)) {1} | head -c {0})'.format(width, manifest_file))
+                array_lines.append('if [[ -n $ENTRY ]]')
+            else:
+                for i, job in enumerate(jobs):
+                    bare_script_file = join(self.config['SCRIPT_HISTORY'], 'init_bare_{0}_{1}.sh'.format(array_id, i))
+                    with open(bare_script_file, 'w') as f:
+                        for line in self.bare_script(job, skip_cmds):
+                            f.write('{0}\n'.format(line))
+                # the task looks up its own script by index, so the launcher has the same size for any number of tasks
+                bare_script_file = join(self.config['SCRIPT_HISTORY'], 'init_bare_{0}_${{SLURM_ARRAY_TASK_ID}}.sh'.format(array_id))
+                array_lines.append('SCRIPT={0}'.format(bare_script_file))
+                array_lines.append('if [[ -f $SCRIPT ]]')
+            array_lines.append('then')
+            if sleep_delay_seconds > 0:
+                array_lines.append('\t sleep $((SLURM_ARRAY_TASK_ID*{0}))'.format(sleep_delay_seconds))
+            # a bundle starts its own srun --exclusive steps, so it runs once in the batch script instead of once per task
+            launcher = 'bash' if 'bundle' in jobs[0] else 'srun bash'
+            if manifest:
+                array_lines.append('\t {0} -c "$(python -c \'import json, sys; print(json.loads(sys.argv[1])["bare"])\' "$ENTRY")"'.format(launcher))
+            else:
+                array_lines.append('\t {0} $SCRIPT'.format(launcher))
             array_lines.append('else')
             array_lines.append('\t echo $SLURM_ARRAY_TASK_ID')
             array_lines.append('fi')
@@ -309,14 +1468,16 @@ class HyakScheduler(object):
                 for line in array_lines:
                     f.write('{0}\n'.format(line))
 
-            print('Writing job list to: {0}'.format(array_job_list))
-            with open(array_job_list, 'w') as f:
-                for line in script_list:
-                    f.write('{0}\n'.format(line))
+            if not manifest:
+                print('Writing job list to: {0}'.format(array_job_list))
+                with open(array_job_list, 'w') as f:
+                    for line in script_list:
+                        f.write('{0}\n'.format(line))
 
-            out, err = execute_and_return('sbatch {0}'.format(array_file))
-            if err != '':
-                print(err)
+            job_id = self.sbatch(array_file, self.dependency(jobs))
+            if job_id is not None:
+                for i, job in enumerate(jobs):
+                    self.set_slurm_id(job, job_id, i)
 
 
 
@@ -324,12 +1485,37 @@ class SshScheduler(object):
 
     """Execute tasks over ssh in the background."""
 
-    def __init__(self, config_folder='./config', verbose=False):
+    def __init__(self, config_folder='./config', verbose=False, poll_workers=POLL_MAX_WORKERS, poll_timeout=POLL_TIMEOUT_SECONDS, smi_query='xml', use_agents=False,
+                 pack_gpus=False, pack_util_threshold=PACK_UTIL_THRESHOLD, pack_max_jobs=PACK_MAX_JOBS, persist_jobs=False, job_db_path=None,
+                 poll_wait=POLL_WAIT_SECONDS, state_ttl=CLUSTER_STATE_TTL_SECONDS, local_hosts=()):
         self.queue = Queue()
         self.host_data = None
-        self.last_polled = datetime.datetime.now() - datetime.timedelta(hours=1)
+        self.lock = threading.Lock()
+        self.poll_workers = poll_workers
+        self.poll_timeout = poll_timeout
+        self.poll_wait = poll_wait
+        self.poll_executor = ThreadPoolExecutor(max_workers=poll_workers)
+        self.polling = set()
+        self.state = ClusterState(state_ttl)
+        self.smi_query = smi_query
+        self.pool = SshConnectionPool()
+        self.syncer = RepoSyncManager(self.pool)
+        self.ssh_executor = SshExecutor(self.pool, self.syncer)
+        self.executors = dict((host, LocalExecutor()) for host in local_hosts)
+        self.use_agents = use_agents
+        self.agents = {}
+        self.gpu_freed = threading.Event()
+        self.claimed = {}
+        self.pack_gpus = pack_gpus
+        self.pack_util_threshold = pack_util_threshold
+        self.pack_max_jobs = pack_max_jobs
+        self.start_latencies = []
+        self.index = None
+        self.num_done = 0
 
         self.host2config = self.init_hosts(config_folder)
+        self.table = ClusterTable(self.host2config, [config['priority'] for config in self.host2config.values()])
+        self.health = dict((host, HostHealth()) for host in self.host2config)
         self.config_folder = config_folder
         self.verbose = verbose
         self.local_config = {}
@@ -337,6 +1523,29 @@ class SshScheduler(object):
         self.init_with_config(config_folder)
         self.init_remap(config_folder)
 
+        self.store = None
+        if persist_jobs:
+            if job_db_path is None:
+                history = self.local_config.get('SCRIPT_HISTORY', self.local_config['LOG_HOME'])
+                if not os.path.exists(history): os.makedirs(history)
+                job_db_path = join(history, 'ssh_jobs.sqlite')
+            self.store = JobStore(job_db_path)
+
+    def completion_index(self):
+        """Gets the CompletionIndex in COMPLETION_INDEX (default: SCRIPT_HISTORY/completed)."""
+        if self.index is None:
+            history = self.local_config.get('SCRIPT_HISTORY', self.local_config['LOG_HOME'])
+            self.index = CompletionIndex(self.local_config.get('COMPLETION_INDEX', join(history, 'completed')))
+        return self.index
+
+    def executor(self, host):
+        """Gets the executor which runs commands on host (ssh unless set otherwise)."""
+        return self.executors.get(host, self.ssh_executor)
+
+    def set_executor(self, host, executor):
+        """Runs everything on host with executor, e.g. LocalExecutor() for this machine."""
+        self.executors[host] = executor
+
     def init_with_config(self, config_folder):
         with open(join(config_folder, 'ssh_config.cfg')) as f:
             for line in f:
@@ -382,50 +1591,120 @@ class SshScheduler(object):
         self.host2config[name]['util_threshold'] = util_threshold
 
 
-    def poll_gpu_status(self):
-        """Polls GPU status (if a GPU is used etc)."""
-        print('Polling a total of {0} hosts...'.format(len(self.host2config)))
-        for i, host in enumerate(self.host2config):
+    def poll_host(self, host):
+        """Runs nvidia-smi on a single host.
+
+        :host: The ssh name of the host.
+        :returns: Tuple of stdout, stderr and the latency of the call in seconds.
+
+        """
+        if self.verbose:
+            print('Polling host {0} ...'.format(host))
+        start = time.time()
+        out, err = self.executor(host).run(host, NVIDIA_SMI_QUERIES[self.smi_query], timeout=self.poll_timeout)
+        return out, err, time.time() - start
+
+    def process_poll(self, host, out, err, latency):
+        """Turns the result of poll_host into an update for host2config."""
+        if self.verbose:
+            print('Host {0} answered in {1:.2f}s.'.format(host, latency))
+        update = {'poll_latency': latency}
+        if err != '':
+            self.health[host].failure()
+            update['status'] = HostState.unknown
+            update['num_available'] = 0
             if self.verbose:
-                print('Polling host {0} ...'.format(host))
-            if i > 0 and i % 3 == 0: print('{0}/{1}'.format(i, len(self.host2config)))
-            strCMD = 'ssh {0} "nvidia-smi -q -x"'.format(host)
-            out, err = execute_and_return(strCMD)
-            if err != '':
-                self.host2config[host]['status'] = HostState.unknown
-                self.host2config[host]['num_available'] = 0
-                if self.verbose:
-                    print('Error in nvidia-smi call!')
-                    print(err)
-                continue
-            gpus, num_available = self.parse_nvidia_smi(out, host)
-            self.host2config[host]['gpus'] = gpus
-            self.host2config[host]['status'] = HostState.available
-            self.host2config[host]['num_available'] = max(num_available-self.host2config[host]['min_free'], 0)
-        self.last_polled = datetime.datetime.now()
+                print('Error in nvidia-smi call!')
+                print(err)
+            return update
+        self.health[host].success()
+        gpus, num_available = self.parse_nvidia_smi(out, host)
+        update['gpus'] = gpus
+        update['status'] = HostState.available
+        update['num_available'] = max(num_available-self.host2config[host]['min_free'], 0)
+        return update
+
+    def apply_late_poll(self, host, future):
+        """Applies the poll of a host which answered after poll_gpu_status returned."""
+        update = self.process_poll(host, *future.result())
+        with self.lock:
+            self.host2config[host].update(update)
+            self.table.update_host(host, self.host2config[host])
+            self.polling.discard(host)
+        self.state.mark_fresh(host)
+        if update.get('num_available', 0) > 0:
+            self.gpu_freed.set()
+
+    def poll_gpu_status(self, hosts=None):
+        """Polls GPU status (if a GPU is used etc).
+
+        All hosts are polled concurrently with a bounded thread pool. The
+        results are collected first and then written to host2config under
+        the scheduler lock, so readers never see a half-updated poll.
+
+        Hosts whose circuit breaker is open are skipped and hosts which are
+        still being polled are not polled twice. Hosts that do not answer
+        within poll_wait seconds do not hold up the caller: their results
+        are applied in the background when they arrive.
+
+        :hosts: The hosts to poll. Defaults to all hosts.
+
+        """
+        hosts = list(self.host2config) if hosts is None else list(hosts)
+        with self.lock:
+            hosts = [host for host in hosts if host not in self.polling and self.health[host].allow()]
+            self.polling.update(hosts)
+        print('Polling a total of {0} hosts...'.format(len(hosts)))
+        if len(hosts) == 0: return
+        start = time.time()
+        futures = dict((self.poll_executor.submit(self.poll_host, host), host) for host in hosts)
+        done, late = wait(futures, timeout=self.poll_wait)
+        updates = {}
+        for future in done:
+            updates[futures[future]] = self.process_poll(futures[future], *future.result())
+
+        with self.lock:
+            for host, update in updates.items():
+                self.host2config[host].update(update)
+                self.table.update_host(host, self.host2config[host])
+                self.polling.discard(host)
+        for host in updates:
+            self.state.mark_fresh(host)
+
+        for future in late:
+            host = futures[future]
+            print('Host {0} did not answer within {1}s. Continuing without it.'.format(host, self.poll_wait))
+            future.add_done_callback(lambda future, host=host: self.apply_late_poll(host, future))
+
+        if len(updates) == 0: return
+        slowest = max(updates, key=lambda host: updates[host]['poll_latency'])
+        print('Polled {0} hosts in {1:.2f}s. Slowest host: {2} ({3:.2f}s).'.format(
+            len(updates), time.time() - start, slowest, updates[slowest]['poll_latency']))
+
+    def refresh(self):
+        """Polls all hosts whose cached state is stale.
+
+        Hosts with a live telemetry agent are always fresh and never polled.
+
+        """
+        stale = self.state.stale(self.hosts_without_agent())
+        if len(stale) > 0:
+            self.poll_gpu_status(stale)
 
     def get_total_available(self):
         """Gets the total amount of GPUs available after min free threshold."""
-        if (datetime.datetime.now() - self.last_polled).total_seconds() > 60:
-            self.poll_gpu_status()
-        total_available = 0
-        total_available_fp16 = 0
-        for host, config in self.host2config.items():
-            if config['status'] != HostState.available:
-                print('Host {0} is down.'.format(host))
+        self.refresh()
+        with self.lock:
+            host_available = self.table.host_available.copy()
+            num_available, avail_fp16 = self.table.count_available()
+        for i, host in enumerate(self.table.hosts):
+            if not host_available[i]:
+                if self.health[host].report():
+                    print('Host {0} is down.'.format(host))
                 continue
-            num_available = config['num_available']
-            min_free = config['min_free']
-
-            total_available += num_available
-            total_fp16 = 0
-            for gpu in config['gpus']:
-                if gpu['status'] == GPUStatus.available and gpu['fp16']:
-                    total_fp16 += 1
-            avail_fp16 = min(num_available, total_fp16)
-            total_available_fp16 += avail_fp16
-
-            print('Host: {0}. Available 16-bit: {2}. Total available {1}.'.format(host, num_available, min(num_available, avail_fp16)))
+            print('Host: {0}. Available 16-bit: {2}. Total available {1}.'.format(host, num_available[i], avail_fp16[i]))
+        total_available = int(num_available.sum())
+        total_available_fp16 = int(avail_fp16.sum())
 
         print('A total of {0} GPUs are available on {1} total hosts.'.format(total_available, len(self.host2config)))
         print('Of these GPUs a total of {0} have 16-bit capability (tensor cores).'.format(total_available_fp16))
@@ -433,19 +1712,26 @@ class SshScheduler(object):
 
 
     def parse_nvidia_smi(self, text, host):
-        """Parses nvidia-smi output."""
-        from bs4 import BeautifulSoup
-        xml_soup = BeautifulSoup(text, 'xml')
-        gpus = []
+        """Parses nvidia-smi output.
+
+        Accepts both the XML output and the csv output of NVIDIA_SMI_QUERIES.
+
+        """
+        if text.lstrip().startswith('<'):
+            gpus = parse_nvidia_smi_xml(text)
+        else:
+            gpus = parse_nvidia_smi_csv(text)
+        num_available = self.annotate_gpus(gpus, host)
+        return gpus, num_available
+
+    def annotate_gpus(self, gpus, host):
+        """Adds fp16, status and performance to parsed GPUs.
+
+        :returns: The number of available GPUs.
+
+        """
         num_available = 0
-        for gpu_node in xml_soup.find_all('gpu'):
-            gpu = {}
-            gpu['name'] = gpu_node.product_name.text
-            gpu['device_id'] = int(gpu_node.minor_number.text)
-            gpu['utilization'] = int(gpu_node.gpu_util.text[:-2])
-            gpu['total_mem'] = int(gpu_node.fb_memory_usage.total.text[:-4])
-            gpu['used_mem'] = int(gpu_node.fb_memory_usage.used.text[:-4])
-            gpu['free_mem'] = int(gpu_node.fb_memory_usage.free.text[:-4])
+        for gpu in gpus:
             gpu['fp16'] = gpu['name'] in gpu_name2fp16
             gpu['status'] = self.determine_gpu_status(gpu, host)
             if gpu['status'] == GPUStatus.available: num_available += 1
@@ -454,8 +1740,55 @@ class SshScheduler(object):
             else:
                 print(gpu['name'], 'NOT IN PERFORMANCE CLASS. PLEASE ADD NOW.')
                 gpu['performance'] = 5
-            gpus.append(gpu)
-        return gpus, num_available
+        return num_available
+
+    def start_agents(self, hosts=None, interval_ms=AGENT_INTERVAL_MS):
+        """Starts the telemetry agent on the given hosts (default: all).
+
+        Hosts with a live agent are no longer polled over ssh; their GPU
+        state is updated as soon as the agent reports a change.
+
+        """
+        hosts = list(self.host2config) if hosts is None else hosts
+        for host in hosts:
+            if host in self.agents and self.agents[host].is_alive(): continue
+            self.agents[host] = TelemetryListener(self, host, interval_ms)
+            self.agents[host].start()
+
+    def stop_agents(self):
+        for agent in self.agents.values():
+            agent.stop()
+        self.agents = {}
+
+    def hosts_without_agent(self):
+        return [host for host in self.host2config if host not in self.agents or not self.agents[host].is_live()]
+
+    def apply_telemetry(self, host, msg):
+        """Applies a message of the telemetry agent to host2config."""
+        with self.lock:
+            config = self.host2config[host]
+            if 'gpus' in msg:
+                gpus = msg['gpus']
+                num_available = self.annotate_gpus(gpus, host)
+                config['gpus'] = gpus
+                config['status'] = HostState.available
+            elif 'd' in msg and 'gpus' in config:
+                device_id, used, free, util = msg['d']
+                num_available = 0
+                for gpu in config['gpus']:
+                    if gpu['device_id'] == device_id:
+                        was_available = gpu['status'] == GPUStatus.available
+                        gpu['used_mem'], gpu['free_mem'], gpu['utilization'] = used, free, util
+                        gpu['status'] = self.determine_gpu_status(gpu, host)
+                        if not was_available and gpu['status'] == GPUStatus.available:
+                            if self.verbose:
+                                print('GPU {0} on host {1} became available.'.format(device_id, host))
+                            self.gpu_freed.set()
+                    if gpu['status'] == GPUStatus.available: num_available += 1
+            else:
+                return
+            config['num_available'] = max(num_available-config['min_free'], 0)
+            self.table.update_host(host, config)
 
 
     def determine_gpu_status(self, gpu, host):
@@ -471,12 +1804,24 @@ class SshScheduler(object):
         else:
             return GPUStatus.busy
 
-    def add_job(self, path, repo_dir, work_dir, cmd, fp16=False, gpus=1, cores=None):
+    def add_job(self, path, repo_dir, work_dir, cmd, fp16=False, gpus=1, cores=None, gpu_mem=None, cost=1.0, deadline=None, after=[], skip_if_done=False):
         """Adds a job to execute.
 
         :path: Sub-folder path for the log file.
         :fp16: If the job requires 16-bit capabilities.
         :gpus: The number of GPUs required for the job.
+        :gpu_mem: Expected GPU memory of the job in MB. With pack_gpus,
+                  single GPU jobs which set it may share a GPU.
+        :cost: Relative runtime estimate. Expensive jobs are started first
+               and on the fastest GPUs.
+        :deadline: Optional datetime.datetime. Jobs with a deadline are
+                   started before all others, earliest deadline first.
+        :after: Handles (returned by add_job) of jobs which must finish
+                successfully before this job starts. If one of them fails,
+                this job is skipped.
+        :skip_if_done: Does not run the job if its command finished
+                       successfully before, see CompletionIndex.
+        :returns: A handle of the job.
 
         """
         job = {}
@@ -486,68 +1831,397 @@ class SshScheduler(object):
         job['cmd'] = cmd
         job['fp16'] = fp16
         job['gpus'] = gpus
+        job['gpu_mem'] = gpu_mem
+        job['cost'] = cost
+        job['deadline'] = deadline
+        job['after'] = [parent for parent in after if not parent.get('done')]
+        job['cmd_hash'] = command_hash(cmd)
+        if skip_if_done and self.completion_index().done(cmd, join(self.local_config['LOG_HOME'], path)):
+            job['done'] = True
+            job['success'] = True
+            self.num_done += 1
+            return job
+        job['enqueued_at'] = time.time()
+        if self.store is not None:
+            job['id'] = JobStore.job_id(job)
+            self.store.add(job)
         self.queue.put(job)
+        return job
 
     def get_gpu_priority_list(self):
-        """Gets the hosts and GPUs on which to execute first."""
-        priority_list = []
-        host_data = self.host_data.sort_values(by=['priority'], ascending=False)
-        for idx, host in host_data.iterrows():
-            name = host['ssh name']
-            if self.host2config[name]['status'] != HostState.available: continue
-            gpus = self.host2config[name]['gpus']
-            num_available = self.host2config[name]['num_available']
-            ids = []
-            performance = []
-            fp16s = []
-            for gpu in gpus:
-                if gpu['status'] != GPUStatus.available: continue
-                ids.append(gpu['device_id'])
-                performance.append(gpu['performance'])
-                fp16s.append(gpu['fp16'])
-            if len(ids) == 0: continue
-            performance, ids = zip(*sorted(zip(performance, ids), reverse=True))
-            for device_id, fp16 in zip(ids[:num_available], fp16s[:num_available]):
-                priority_list.append((name, device_id, fp16))
-        return priority_list
-
-
-    def run_jobs(self, cmds=[], host2cmd_adds={}):
-        gpus_available = self.get_total_available()
-
-        while self.queue.qsize() > 0:
-            workers = []
-            print('Total jobs left: {0}.'.format(self.queue.qsize()))
-            print('Calculating priority list...')
-            priority_list = self.get_gpu_priority_list()
-            print('{0}: Starting jobs...'.format(datetime.datetime.now()))
-            for i in range(min(gpus_available, self.queue.qsize(), len(priority_list))):
-                host, device_id, fp16 = priority_list[i]
-                if (host, device_id) in self.remap:
-                    device_id = self.remap[(host, device_id)]
-                job = self.queue.get()
+        """Gets the hosts and GPUs on which to execute first.
+
+        :returns: List of (host, device_id, fp16) tuples, see ClusterTable.priority_order.
+
+        """
+        table = self.table
+        rows = table.priority_order()
+        hosts = table.host[rows].tolist()
+        return [(table.hosts[i], device_id, fp16) for i, device_id, fp16 in zip(hosts, table.device[rows].tolist(), table.fp16[rows].tolist())]
+
+
+    def job_started(self, job):
+        """Records the time from enqueueing a job until it started."""
+        job['started_at'] = time.time()
+        latency = job['started_at'] - job['enqueued_at']
+        if self.store is not None:
+            self.store.update(job, JobState.running)
+        with self.lock:
+            self.start_latencies.append(latency)
+        if self.verbose:
+            print('Job started {0:.1f}s after it was enqueued: {1}'.format(latency, job['cmd']))
+
+    def worker_done(self, worker):
+        """Releases the GPUs of a finished worker and wakes up the dispatch loop."""
+        worker.job['success'] = worker.success
+        if worker.success:
+            self.completion_index().mark(worker.job.get('cmd_hash') or command_hash(worker.job['cmd']))
+        if self.store is not None:
+            self.store.update(worker.job, JobState.finished if worker.success else JobState.failed)
+        with self.lock:
+            for slot in worker.slots:
+                if slot not in self.claimed: continue
+                self.claimed[slot].remove(worker.job)
+                if len(self.claimed[slot]) == 0: self.claimed.pop(slot)
+        self.state.invalidate(worker.host_name)
+        self.gpu_freed.set()
+
+    def get_free_slots(self):
+        """Gets the priority list without the GPUs claimed by running workers."""
+        with self.lock:
+            return [slot for slot in self.get_gpu_priority_list() if (slot[0], slot[1]) not in self.claimed]
+
+    def get_topology(self, host):
+        """Gets the GPU interconnect of a host. Queried once and then cached."""
+        if 'topology' not in self.host2config[host]:
+            out, err = self.executor(host).run(host, 'nvidia-smi topo -m', timeout=self.poll_timeout)
+            if out == '':
+                if self.verbose:
+                    print('Could not query topology of host {0}: {1}'.format(host, err))
+                return {}
+            self.host2config[host]['topology'] = parse_nvidia_smi_topo(out)
+        return self.host2config[host]['topology']
+
+    def pick_connected(self, host, slots, k):
+        """Picks k of the slots of a host with the best interconnect between them.
+
+        Grows a group greedily from every possible first GPU by adding the
+        GPU with the cheapest links to the group and keeps the cheapest group.
+
+        """
+        links = self.get_topology(host)
+        if len(links) == 0: return slots[:k]
+        cost = lambda a, b: topology_cost(links.get((a[1], b[1]), 'SYS'))
+        best, best_cost = None, None
+        for seed in slots:
+            group = [seed]
+            group_cost = 0
+            while len(group) < k:
+                candidates = [slot for slot in slots if slot not in group]
+                costs = [sum(cost(slot, other) for other in group) for slot in candidates]
+                i = int(np.argmin(costs))
+                group.append(candidates[i])
+                group_cost += costs[i]
+            if best is None or group_cost < best_cost:
+                best, best_cost = group, group_cost
+        return sorted(best, key=lambda slot: slot[1])
+
+    def get_gpu(self, host, device_id):
+        for gpu in self.host2config[host].get('gpus', []):
+            if gpu['device_id'] == device_id: return gpu
+        return None
+
+    def pack_headroom(self, host, device_id, jobs):
+        """Gets the GPU memory in MB that is left for another packed job.
+
+        Memory of our own jobs which did not show up in the last poll yet is
+        counted by their declared gpu_mem.
+
+        :jobs: Our jobs which already run on the GPU.
+        :returns: The free memory or -1 if the GPU cannot take another job.
+
+        """
+        gpu = self.get_gpu(host, device_id)
+        if gpu is None or len(jobs) >= self.pack_max_jobs: return -1
+        if gpu['utilization'] >= self.pack_util_threshold: return -1
+        used = max(gpu['used_mem'], sum(job['gpu_mem'] for job in jobs))
+        return gpu['total_mem'] - used - PACK_MEM_MARGIN_MB
+
+    def pack(self, job, free_slots, placed=None, fp16=None):
+        """Finds a GPU for a job in packing mode.
+
+        GPUs which already run packed jobs are filled first (best fit). If
+        none of them has enough memory left, the job opens a free GPU.
+
+        :placed: Dictionary (host, device_id) -> jobs which were placed on
+                 the GPU in the current dispatch pass but are not claimed yet.
+        :fp16: If True or False, only shared GPUs with or without 16-bit
+               support are used, like the free_slots which match_jobs chose.
+        :returns: A (host, device_id, fp16) slot or None.
+
+        """
+        best, best_headroom = None, None
+        with self.lock:
+            slot2jobs = dict((slot, list(jobs)) for slot, jobs in self.claimed.items())
+        for slot, jobs in (placed or {}).items():
+            slot2jobs.setdefault(slot, []).extend(jobs)
+        shared = [(slot, jobs) for slot, jobs in slot2jobs.items() if all(claim.get('packed') for claim in jobs)]
+        for (host, device_id), jobs in shared:
+            gpu = self.get_gpu(host, device_id)
+            if fp16 is not None and (gpu is None or gpu['fp16'] != fp16): continue
+            headroom = self.pack_headroom(host, device_id, jobs)
+            if headroom < job['gpu_mem']: continue
+            if best is None or headroom < best_headroom:
+                best, best_headroom = (host, device_id, gpu['fp16']), headroom
+        if best is not None: return best
+        for slot in free_slots:
+            if self.pack_headroom(slot[0], slot[1], []) >= job['gpu_mem']: return slot
+        return None
+
+    def allocate(self, job, free_slots, placed=None, fp16=None):
+        """Selects the GPUs for a job.
+
+        A job with more than one GPU is only placed on a single host which
+        has enough free GPUs, preferring hosts with a higher priority.
+
+        :free_slots: The free (host, device_id, fp16) slots in priority order.
+        :placed: Packed jobs of the current dispatch pass, see pack.
+        :fp16: Restricts packing onto shared GPUs, see pack.
+        :returns: List of slots or None if the job does not fit.
+
+        """
+        if self.pack_gpus and job['gpus'] <= 1 and job['gpu_mem'] is not None:
+            slot = self.pack(job, free_slots, placed, fp16)
+            if slot is None: return None
+            job['packed'] = True
+            return [slot]
+        if job['gpus'] <= 1:
+            return free_slots[:1] if len(free_slots) > 0 else None
+        host2slots = OrderedDict()
+        for slot in free_slots:
+            host2slots.setdefault(slot[0], []).append(slot)
+        for host, slots in host2slots.items():
+            if len(slots) < job['gpus']: continue
+            return self.pick_connected(host, slots, job['gpus'])
+        return None
+
+    def job_order(self, job):
+        """Sort key of pending jobs: deadlines first, then the most expensive jobs."""
+        if job['deadline'] is not None:
+            return (0, job['deadline'].timestamp(), -job['cost'])
+        return (1, 0, -job['cost'])
+
+    def match_jobs(self, pending, free_slots):
+        """Assigns pending jobs to free GPUs.
+
+        Jobs are taken in job_order and each one gets the fastest free GPUs
+        it may use, so long jobs end up on fast tensor core cards and short
+        ones on slower cards. Which GPUs are used at all still follows the
+        host priorities: if there are fewer jobs than free GPUs, only the hosts
+        at the front of the priority list are considered, just enough whole
+        hosts to cover the GPUs the jobs need. Jobs with fp16 need
+        a GPU with 16-bit support (if the cluster has any), and jobs without
+        fp16 leave those GPUs alone while fp16 jobs are still waiting for them.
+
+        :pending: The jobs waiting to be started.
+        :free_slots: The free (host, device_id, fp16) slots in priority order.
+        :returns: List of (job, slots) tuples.
+
+        """
+        jobs = sorted(pending, key=self.job_order)
+        fp16_cluster = any(gpu['fp16'] for config in self.host2config.values() for gpu in config.get('gpus', []))
+        demand = sum(job['gpus'] for job in jobs)
+        if demand < len(free_slots) and not self.pack_gpus:
+            # hosts are kept whole, so a job with several GPUs still finds a host which has enough of them
+            candidates = []
+            for host in OrderedDict.fromkeys(slot[0] for slot in free_slots):
+                if len(candidates) >= demand: break
+                candidates.extend(slot for slot in free_slots if slot[0] == host)
+            fp16_missing = sum(job['gpus'] for job in jobs if job['fp16']) - len([slot for slot in candidates if slot[2]])
+            for slot in free_slots:
+                if fp16_missing <= 0: break
+                if not slot[2] or slot in candidates: continue
+                candidates.append(slot)
+                fp16_missing -= 1
+            free_slots = candidates
+        performance = lambda slot: self.get_gpu(slot[0], slot[1])['performance']
+        free_slots = sorted(free_slots, key=performance, reverse=True)
+
+        assignments = []
+        # packed jobs of this pass are only claimed after it, so their GPUs are tracked here
+        placed = {}
+        fp16_demand = sum(job['gpus'] for job in jobs if job['fp16']) if fp16_cluster else 0
+        for job in jobs:
+            if len(free_slots) == 0 and not self.pack_gpus: break
+            if job['fp16'] and fp16_cluster:
+                fp16 = True
+            elif fp16_demand > 0 and fp16_demand >= len([slot for slot in free_slots if slot[2]]):
+                fp16 = False
+            else:
+                fp16 = None
+            eligible = free_slots if fp16 is None else [slot for slot in free_slots if slot[2] == fp16]
+            slots = self.allocate(job, eligible, placed, fp16)
+            if slots is None: continue
+            if job.get('packed'):
+                placed.setdefault((slots[0][0], slots[0][1]), []).append(job)
+            if job['fp16'] and fp16_cluster: fp16_demand -= job['gpus']
+            free_slots = [slot for slot in free_slots if slot not in slots]
+            assignments.append((job, slots))
+        return assignments
+
+    def print_start_latencies(self):
+        if len(self.start_latencies) == 0: return
+        latencies = np.array(self.start_latencies)
+        print('Time from enqueued to started for {0} jobs: mean {1:.1f}s, median {2:.1f}s, max {3:.1f}s.'.format(
+            len(latencies), latencies.mean(), np.median(latencies), latencies.max()))
+
+    def skip_job(self, job, pending):
+        pending.remove(job)
+        job['success'] = False
+        if self.store is not None:
+            self.store.update(job, JobState.failed)
+
+    def skip_failed_dependents(self, pending):
+        """Skips pending jobs with a failed parent, and then their dependents in turn."""
+        skipped = True
+        while skipped:
+            skipped = False
+            for job in list(pending):
+                if any(parent.get('success') is False for parent in job['after']):
+                    print('A parent job failed. Skipping: {0}'.format(job['cmd']))
+                    self.skip_job(job, pending)
+                    skipped = True
+
+    def drain_queue(self, pending):
+        """Moves jobs added with add_job to the pending list of run_jobs."""
+        while True:
+            try:
+                pending.append(self.queue.get_nowait())
+            except Empty:
+                return
+
+    def resume_jobs(self, pending):
+        """Merges the unfinished jobs of the job store into the pending jobs.
+
+        Pending jobs which already finished in an earlier run are dropped
+        and count as successful parents of the jobs which depend on them.
+
+        """
+        states = self.store.states()
+        pending_ids = set(job['id'] for job in pending)
+        resumed = []
+        for job in pending:
+            if states.get(job['id']) == JobState.finished:
+                job['success'] = True
+            else:
+                resumed.append(job)
+        skipped = len(pending) - len(resumed)
+        unfinished = [JobState.queued, JobState.dispatched, JobState.running, JobState.failed]
+        for job in self.store.load(unfinished):
+            if job['id'] in pending_ids: continue
+            job['enqueued_at'] = time.time()
+            resumed.append(job)
+        # loaded jobs refer to their parents by id; parents which are not resumed have finished
+        id2job = dict((job['id'], job) for job in resumed)
+        for job in resumed:
+            job['after'] = [id2job[parent] if isinstance(parent, str) else parent for parent in job.get('after', [])
+                            if not isinstance(parent, str) or parent in id2job]
+        print('Resuming {0} jobs. Skipping {1} finished jobs.'.format(len(resumed), skipped))
+        return resumed
+
+    def run_jobs(self, cmds=[], host2cmd_adds={}, poll_interval=60, resume=False):
+        """Runs all queued jobs.
+
+        Jobs are started as soon as enough GPUs are free. The dispatch loop
+        sleeps until a worker finishes, a telemetry agent reports a freed GPU,
+        or poll_interval seconds have passed, whichever comes first. Then only
+        the hosts whose cached state is stale are polled: hosts which got or
+        finished a job and hosts whose ttl ran out.
+
+        Jobs with gpus > 1 get all their GPUs on one host. Pending jobs are
+        matched to GPUs by match_jobs, and a job that does not fit yet does
+        not block smaller jobs behind it. With pack_gpus, single GPU jobs that
+        declare gpu_mem are packed onto GPUs by their memory footprint.
+
+        :cmds: Additional commands executed before each job.
+        :host2cmd_adds: Strings appended to the job command on specific hosts.
+        :poll_interval: Seconds between full polls of all hosts.
+        :resume: Requires persist_jobs. Also runs the unfinished jobs of
+                 earlier runs in the job store and skips jobs that already
+                 finished in an earlier run.
+
+        """
+        if self.use_agents:
+            self.start_agents()
+        self.syncer.reset()
+        self.get_total_available()
+        if self.num_done > 0:
+            print('Skipping {0} jobs which already finished.'.format(self.num_done))
+            self.num_done = 0
+
+        workers = []
+        pending = []
+        idx = 0
+        if resume and self.store is None:
+            print('Cannot resume without a job store. Use SshScheduler(persist_jobs=True).')
+        elif resume:
+            self.drain_queue(pending)
+            pending = self.resume_jobs(pending)
+        while True:
+            self.drain_queue(pending)
+            workers = [worker for worker in workers if worker.is_alive()]
+            if len(pending) > 0:
+                print('Total jobs left: {0}. Running: {1}.'.format(len(pending), len(workers)))
+            self.gpu_freed.clear()
+            max_gpus = max([len(config.get('gpus', [])) for config in self.host2config.values()])
+            for job in list(pending):
+                if job['gpus'] > max_gpus > 0:
+                    print('Job needs {0} GPUs but no host has that many. Skipping: {1}'.format(job['gpus'], job['cmd']))
+                    self.skip_job(job, pending)
+            self.skip_failed_dependents(pending)
+            ready = [job for job in pending if all(parent.get('success') for parent in job['after'])]
+            if len(ready) == 0 and len(pending) > 0 and len(workers) == 0:
+                print('{0} jobs wait for parent jobs which were never run. Stopping.'.format(len(pending)))
+                break
+
+            for job, slots in self.match_jobs(ready, self.get_free_slots()):
+                pending.remove(job)
+                host = slots[0][0]
+                device_ids = [self.remap.get((host, device_id), device_id) for _, device_id, _ in slots]
+                device_id = ','.join(str(device_id) for device_id in device_ids)
+                slots = [(host, device_id) for host, device_id, _ in slots]
 
                 if host in host2cmd_adds:
                     job['cmd'] += host2cmd_adds[host]
 
-                workers.append(GPUWorker(self, self.local_config, self.config_folder, self.local_config['LOG_HOME'], host, self.host2config[host], device_id, job, i, cmds))
-
-            for worker in workers:
-                time.sleep(5)
+                with self.lock:
+                    for slot in slots:
+                        self.claimed.setdefault(slot, []).append(job)
+                if self.store is not None:
+                    self.store.update(job, JobState.dispatched, host, device_id)
+                self.state.invalidate(host)
+                worker = GPUWorker(self, self.local_config, self.config_folder, self.local_config['LOG_HOME'], host, self.host2config[host], device_id, job, idx, cmds, slots=slots)
+                print('{0}: Starting job {1} on {2}:{3}...'.format(datetime.datetime.now(), idx, host, device_id))
                 worker.start()
+                workers.append(worker)
+                idx += 1
 
-            if self.queue.qsize() > 0:
-                for i in range(5):
-                    time.sleep(20 + np.random.randint(1, 7)) # wait for 20 seconds + some random amount of time
-                    if self.queue.qsize() == 0: break
-                if self.queue.qsize() > 0:
-                    self.poll_gpu_status()
-                    print('Getting total available...')
-                    gpus_available = self.get_total_available()
-            else:
-                for worker in workers:
-                    if self.verbose:
-                        print('Waiting for worker: {0}'.format(worker.idx))
-                    worker.join()
+            if self.store is not None:
+                self.store.flush()
+            if len(pending) == 0 and len(workers) == 0: break
+            if len(pending) == 0:
+                if self.verbose:
+                    print('Waiting for {0} workers...'.format(len(workers)))
+                self.gpu_freed.wait(poll_interval)
+                continue
 
+            self.gpu_freed.wait(poll_interval)
+            self.refresh()
 
+        self.print_start_latencies()
+        if self.store is not None:
+            self.store.flush()
+            print('Job store {0}: {1}'.format(self.store.path, self.store.summary()))
+        if self.use_agents:
+            self.stop_agents()
+        self.pool.close()
@@ -0,0 +1,753 @@
+"""Local stand-in for a Slurm cluster.
+
+Emulates the Slurm commands which the schedulers and the tools of this repo
+call (sbatch, squeue, sacct, scontrol, sacctmgr, srun, scancel) on a pool of
+simulated GPU nodes. Jobs and array tasks run as local processes. The shims
+in bin/fakeslurm call this module, so putting them first on the PATH is
+enough to run HyakScheduler, restart_failed.py and the usage tools end to
+end without a cluster:
+
+    export PATH=$PWD/bin/fakeslurm:$PATH
+    python my_grid.py            # HyakScheduler.run_jobs() submits to the emulator
+    squeue -u $USER              # the real output formats
+    sacct -X -S 2021-01-01 -p
+
+The state lives in FAKESLURM_HOME (default /tmp/fakeslurm) and is shared by
+all commands through a file lock. sbatch starts a scheduler daemon which
+starts pending jobs on free nodes and records how they finished. It exits
+once the queue has been empty for a while. Only the standard library is
+used. The node pool and the limits are set with environment variables:
+
+    FAKESLURM_NODES            number of nodes (default 2)
+    FAKESLURM_GPUS_PER_NODE    GPUs per node (default 8)
+    FAKESLURM_CPUS_PER_NODE    CPUs per node (default 64)
+    FAKESLURM_MEM_PER_NODE     memory per node in GB (default 512)
+    FAKESLURM_MAX_ARRAY_SIZE   MaxArraySize (default 1001)
+    FAKESLURM_MAX_SUBMIT       MaxSubmit of every user (default: unlimited)
+"""
+import datetime
+import fcntl
+import getpass
+import json
+import os
+import re
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+from contextlib import contextmanager
+from os.path import join
+
+HOME = os.environ.get('FAKESLURM_HOME', '/tmp/fakeslurm')
+NUM_NODES = int(os.environ.get('FAKESLURM_NODES', 2))
+GPUS_PER_NODE = int(os.environ.get('FAKESLURM_GPUS_PER_NODE', 8))
+CPUS_PER_NODE = int(os.environ.get('FAKESLURM_CPUS_PER_NODE', 64))
+MEM_PER_NODE = int(os.environ.get('FAKESLURM_MEM_PER_NODE', 512))
+MAX_ARRAY_SIZE = int(os.environ.get('FAKESLURM_MAX_ARRAY_SIZE', 1001))
+MAX_SUBMIT = int(os.environ['FAKESLURM_MAX_SUBMIT']) if os.environ.get('FAKESLURM_MAX_SUBMIT') else None
+TICK_SECONDS = 0.2
+DAEMON_IDLE_SECONDS = 10
+
+ACTIVE_STATES = ['PENDING', 'RUNNING']
+STATE_CODES = {'PENDING': 'PD', 'RUNNING': 'R', 'COMPLETED': 'CD', 'FAILED': 'F', 'TIMEOUT': 'TO', 'CANCELLED': 'CA'}
+# options without a value and the long names of short options, per command
+SBATCH_FLAGS = set(['requeue', 'no-requeue', 'exclusive', 'parsable', 'hold', 'overcommit'])
+SBATCH_OPTIONS = {'J': 'job-name', 'A': 'account', 'p': 'partition', 'N': 'nodes', 'n': 'ntasks', 'c': 'cpus-per-task', 't': 'time',
+                  'o': 'output', 'e': 'error', 'a': 'array', 'd': 'dependency', 'D': 'chdir', 'G': 'gpus', 'C': 'constraint',
+                  'x': 'exclude', 'b': 'begin'}
+SQUEUE_FLAGS = set(['noheader', 'array', 'long', 'all', 'h', 'r', 'l'])
+SQUEUE_OPTIONS = {'u': 'user', 't': 'states', 'o': 'format', 'O': 'Format', 'j': 'jobs', 'p': 'partition', 'A': 'account', 'S': 'sort'}
+SQUEUE_LABELS = {'username': 'USER', 'timeused': 'TIME', 'timelimit': 'TIME_LIMIT', 'numnodes': 'NODES', 'numcpus': 'CPUS',
+                 'minmemory': 'MIN_MEMORY', 'submittime': 'SUBMIT_TIME', 'endtime': 'END_TIME', 'statecompact': 'ST',
+                 'arrayjobid': 'ARRAY_JOB_ID', 'arraytaskid': 'ARRAY_TASK_ID', 'tres-per-node': 'TRES_PER_NODE'}
+SACCT_FLAGS = set(['noheader', 'allusers', 'allocations', 'parsable', 'parsable2', 'long', 'X', 'n', 'a', 'p', 'P', 'l'])
+SACCT_OPTIONS = {'S': 'starttime', 'E': 'endtime', 'u': 'user', 'j': 'jobs', 'o': 'format', 's': 'state', 'r': 'partition', 'A': 'account'}
+
+
+def node_names():
+    return ['node{0:03d}'.format(i+1) for i in range(NUM_NODES)]
+
+@contextmanager
+def locked_state():
+    """Loads the state under an exclusive lock and saves it afterwards."""
+    os.makedirs(HOME, exist_ok=True)
+    with open(join(HOME, 'state.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path = join(HOME, 'state.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+        else:
+            state = {'next_id': 1000, 'jobs': [], 'envs': {}}
+        yield state
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(path + '.tmp', path)
+
+def parse_options(tokens, flags=SBATCH_FLAGS, short_options=SBATCH_OPTIONS):
+    """Parses Slurm style options. Returns the options and the remaining arguments.
+
+    :flags: Options which do not take a value (long or single letter).
+    :short_options: Maps single letter options to their long names.
+
+    """
+    options = {}
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if not token.startswith('-') or token == '-': break
+        if token.startswith('--'):
+            name, _, value = token[2:].partition('=')
+            if value == '' and '=' not in token and name not in flags:
+                i += 1
+                value = tokens[i] if i < len(tokens) else ''
+        else:
+            name, value = token[1:2], token[2:]
+            if name in flags and value == '':
+                value = True
+            elif value == '':
+                i += 1
+                value = tokens[i] if i < len(tokens) else ''
+            name = short_options.get(name, name)
+        options[name] = True if value == '' and name in flags else value
+        i += 1
+    return options, tokens[i:]
+
+def parse_time(value):
+    """Parses a Slurm time limit ([D-]HH:MM:SS, MM, MM:SS, ...) into seconds."""
+    if value in [None, '', 'UNLIMITED', 'infinite']: return None
+    days = 0
+    if '-' in value:
+        days, value = value.split('-')
+        parts = [int(part) for part in value.split(':')] + [0]*(3 - len(value.split(':')))
+        return ((int(days)*24 + parts[0])*60 + parts[1])*60 + parts[2]
+    parts = [int(part) for part in value.split(':')]
+    if len(parts) == 1: return parts[0]*60
+    if len(parts) == 2: return parts[0]*60 + parts[1]
+    return (parts[0]*60 + parts[1])*60 + parts[2]
+
+def parse_mem(value):
+    """Parses a --mem value into GB."""
+    match = re.match(r'(\d+)([KMGT]?)', value.upper())
+    if match is None: return 4
+    scale = {'K': 1.0/1024**2, 'M': 1.0/1024, '': 1.0/1024, 'G': 1, 'T': 1024}[match.group(2)]
+    return max(int(-(-int(match.group(1))*scale // 1)), 1)
+
+def parse_begin(value):
+    if value is None: return None
+    match = re.match(r'now\+(\d+)(seconds|minutes|hours|days)?', value)
+    if match is not None:
+        unit = {'seconds': 1, 'minutes': 60, 'hours': 3600, 'days': 86400}[match.group(2) or 'seconds']
+        return time.time() + int(match.group(1))*unit
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+def parse_array(value):
+    """Parses an --array value like 0-9, 1,3,5 or 0-99%4 into task ids and the throttle."""
+    throttle = None
+    if '%' in value:
+        value, throttle = value.split('%')
+        throttle = int(throttle)
+    task_ids = []
+    for part in value.split(','):
+        step = 1
+        if ':' in part:
+            part, step = part.split(':')
+            step = int(step)
+        if '-' in part:
+            start, end = part.split('-')
+            task_ids.extend(range(int(start), int(end) + 1, step))
+        else:
+            task_ids.append(int(part))
+    return task_ids, throttle
+
+def format_duration(seconds):
+    seconds = int(max(seconds, 0))
+    days, seconds = divmod(seconds, 86400)
+    text = '{0:02d}:{1:02d}:{2:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    return text if days == 0 else '{0}-{1}'.format(days, text)
+
+def format_timestamp(timestamp):
+    if timestamp is None: return 'Unknown'
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S')
+
+def display_id(job):
+    if job['array_job_id'] is None: return str(job['id'])
+    return '{0}_{1}'.format(job['array_job_id'], job['task_id'])
+
+def expand_pattern(pattern, job):
+    """Replaces the filename patterns of --output and --error."""
+    replacements = {'%A': str(job['array_job_id'] or job['id']), '%a': str(job['task_id'] if job['task_id'] is not None else 4294967294),
+                    '%j': str(job['id']), '%x': job['name'], '%u': job['user'], '%N': (job['nodes'] or ['node'])[0]}
+    for key, value in replacements.items():
+        pattern = pattern.replace(key, value)
+    return pattern.replace('%%', '%')
+
+
+def sbatch(argv):
+    options, args = parse_options(argv)
+    if len(args) > 0:
+        with open(args[0]) as f:
+            script = f.read()
+    else:
+        script = sys.stdin.read()
+    script_options = {}
+    for line in script.split('\n'):
+        if line.startswith('#SBATCH'):
+            parsed, _ = parse_options(shlex.split(line[len('#SBATCH'):]))
+            script_options.update(parsed)
+        elif line.strip() != '' and not line.startswith('#'):
+            break
+    script_options.update(options)
+    options = script_options
+
+    nodes = int(options.get('nodes', 1))
+    gpus = 0
+    if 'gpus-per-node' in options:
+        gpus = int(options['gpus-per-node'].split(':')[-1])
+    elif 'gres' in options and 'gpu' in options['gres']:
+        gpus = int(options['gres'].split(':')[-1])
+    elif 'gpus' in options:
+        gpus = -(-int(options['gpus'].split(':')[-1]) // nodes)
+    if 'ntasks-per-node' in options:
+        ntasks = int(options['ntasks-per-node'])*nodes
+    else:
+        ntasks = int(options.get('ntasks', nodes))
+    cpus = -(-ntasks // nodes)*int(options.get('cpus-per-task', 1))
+    mem = parse_mem(options.get('mem', '4G'))
+    if nodes > NUM_NODES or gpus > GPUS_PER_NODE or cpus > CPUS_PER_NODE or mem > MEM_PER_NODE:
+        print('sbatch: error: Batch job submission failed: Requested node configuration is not available', file=sys.stderr)
+        return 1
+
+    task_ids, throttle = [None], None
+    if 'array' in options:
+        task_ids, throttle = parse_array(options['array'])
+        if max(task_ids) >= MAX_ARRAY_SIZE:
+            print('sbatch: error: Batch job submission failed: Invalid job array specification', file=sys.stderr)
+            return 1
+
+    user = getpass.getuser()
+    chdir = os.path.abspath(options.get('chdir', os.getcwd()))
+    default_output = 'slurm-%A_%a.out' if 'array' in options else 'slurm-%j.out'
+    with locked_state() as state:
+        active = len([job for job in state['jobs'] if job['user'] == user and job['state'] in ACTIVE_STATES])
+        if MAX_SUBMIT is not None and active + len(task_ids) > MAX_SUBMIT:
+            print('sbatch: error: QOSMaxSubmitJobPerUserLimit', file=sys.stderr)
+            print("sbatch: error: Batch job submission failed: Job violates accounting/QOS policy (job submit limit, user's size and/or time limits)", file=sys.stderr)
+            return 1
+        first_id = state['next_id']
+        state['next_id'] += len(task_ids)
+        script_path = join(HOME, 'scripts', '{0}.sh'.format(first_id))
+        os.makedirs(join(HOME, 'scripts'), exist_ok=True)
+        with open(script_path, 'w') as f:
+            f.write(script)
+        state['envs'][str(first_id)] = dict(os.environ)
+        for i, task_id in enumerate(task_ids):
+            job = {}
+            job['id'] = first_id + i
+            job['array_job_id'] = None if task_id is None else first_id
+            job['task_id'] = task_id
+            job['throttle'] = throttle
+            job['name'] = options.get('job-name', os.path.basename(args[0]) if len(args) > 0 else 'sbatch')
+            job['user'] = user
+            job['account'] = options.get('account', user)
+            job['partition'] = options.get('partition', 'gpu')
+            job['num_nodes'] = nodes
+            job['gpus'] = gpus
+            job['cpus'] = cpus
+            job['ntasks'] = ntasks
+            job['mem'] = mem
+            job['time_limit'] = parse_time(options.get('time'))
+            job['begin'] = parse_begin(options.get('begin'))
+            job['exclude'] = [name for name in options.get('exclude', '').split(',') if name != '']
+            job['dependency'] = options.get('dependency')
+            job['kill_on_invalid_dep'] = options.get('kill-on-invalid-dep', 'no') == 'yes'
+            job['comment'] = options.get('comment', '')
+            job['chdir'] = chdir
+            job['output'] = join(chdir, options.get('output', default_output))
+            job['error'] = join(chdir, options.get('error', options.get('output', default_output)))
+            job['append'] = options.get('open-mode', 'truncate') == 'append'
+            job['script'] = script_path
+            job['env'] = str(first_id)
+            job['state'] = 'PENDING'
+            job['reason'] = 'None'
+            job['submit'] = time.time()
+            job['start'] = None
+            job['end'] = None
+            job['exit_code'] = None
+            job['nodes'] = []
+            job['devices'] = []
+            job['pid'] = None
+            state['jobs'].append(job)
+    start_daemon()
+    if options.get('parsable'):
+        print(first_id)
+    else:
+        print('Submitted batch job {0}'.format(first_id))
+    return 0
+
+def start_daemon():
+    """Starts the scheduler daemon unless one is running."""
+    os.makedirs(HOME, exist_ok=True)
+    with open(join(HOME, 'daemon.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    with open(join(HOME, 'daemon.log'), 'a') as log:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), 'daemon'], stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                         start_new_session=True, cwd=HOME)
+
+def daemon(argv):
+    with open(join(HOME, 'daemon.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return 0
+        idle_since = time.time()
+        while time.time() - idle_since < DAEMON_IDLE_SECONDS:
+            with locked_state() as state:
+                active = schedule(state)
+            if active: idle_since = time.time()
+            time.sleep(TICK_SECONDS)
+    return 0
+
+
+def find_jobs(state, ref):
+    """Finds the jobs a dependency refers to: a job, a whole array or a single array task."""
+    if '_' in ref:
+        array_job_id, task_id = [int(value) for value in ref.split('_')]
+        return [job for job in state['jobs'] if job['array_job_id'] == array_job_id and job['task_id'] == task_id]
+    ref = int(ref)
+    return [job for job in state['jobs'] if job['id'] == ref or job['array_job_id'] == ref]
+
+def dependency_status(state, job):
+    """Returns 'ok', 'wait' or 'never' for the dependency of a job."""
+    if job['dependency'] is None: return 'ok'
+    status = 'ok'
+    for clause in job['dependency'].split(','):
+        kind, _, refs = clause.partition(':')
+        for ref in refs.split(':'):
+            if kind == 'aftercorr':
+                parents = find_jobs(state, '{0}_{1}'.format(ref, job['task_id']))
+            else:
+                parents = find_jobs(state, ref)
+            for parent in parents:
+                if parent['state'] in ACTIVE_STATES:
+                    status = 'wait'
+                elif kind in ['afterok', 'aftercorr'] and parent['state'] != 'COMPLETED':
+                    return 'never'
+                elif kind == 'afternotok' and parent['state'] == 'COMPLETED':
+                    return 'never'
+    return status
+
+def free_resources(state):
+    free = dict((name, {'gpus': list(range(GPUS_PER_NODE)), 'cpus': CPUS_PER_NODE, 'mem': MEM_PER_NODE}) for name in node_names())
+    for job in state['jobs']:
+        if job['state'] != 'RUNNING': continue
+        for name in job['nodes']:
+            free[name]['cpus'] -= job['cpus']
+            free[name]['mem'] -= job['mem']
+            free[name]['gpus'] = [device for device in free[name]['gpus'] if device not in job['devices']]
+    return free
+
+def finish(job, state_name, exit_code):
+    job['state'] = state_name
+    job['exit_code'] = exit_code
+    job['end'] = time.time()
+    job['reason'] = 'None'
+
+def schedule(state):
+    """Updates running jobs and starts pending jobs which fit. Returns True if any job is active."""
+    now = time.time()
+    # reap the job processes which exited, their exit codes are in the exit files
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0] != 0: pass
+    except ChildProcessError:
+        pass
+    for job in state['jobs']:
+        if job['state'] != 'RUNNING': continue
+        exit_file = join(HOME, 'exit', str(job['id']))
+        if os.path.exists(exit_file):
+            with open(exit_file) as f:
+                exit_code = int(f.read().strip() or 1)
+            finish(job, 'COMPLETED' if exit_code == 0 else 'FAILED', exit_code)
+        elif job['time_limit'] is not None and now - job['start'] > job['time_limit']:
+            kill(job)
+            finish(job, 'TIMEOUT', 0)
+        elif not pid_alive(job['pid']):
+            finish(job, 'FAILED', 1)
+
+    free = free_resources(state)
+    running_per_array = {}
+    for job in state['jobs']:
+        if job['state'] == 'RUNNING' and job['array_job_id'] is not None:
+            running_per_array[job['array_job_id']] = running_per_array.get(job['array_job_id'], 0) + 1
+    active = False
+    for job in state['jobs']:
+        if job['state'] != 'PENDING': continue
+        active = True
+        if job['begin'] is not None and now < job['begin']:
+            job['reason'] = 'BeginTime'
+            continue
+        status = dependency_status(state, job)
+        if status == 'never':
+            if job['kill_on_invalid_dep']:
+                finish(job, 'CANCELLED', 0)
+            else:
+                job['reason'] = 'DependencyNeverSatisfied'
+            continue
+        if status == 'wait':
+            job['reason'] = 'Dependency'
+            continue
+        if job['throttle'] is not None and running_per_array.get(job['array_job_id'], 0) >= job['throttle']:
+            job['reason'] = 'JobArrayTaskLimit'
+            continue
+        nodes = [name for name in node_names() if name not in job['exclude'] and len(free[name]['gpus']) >= job['gpus']
+                 and free[name]['cpus'] >= job['cpus'] and free[name]['mem'] >= job['mem']][:job['num_nodes']]
+        if len(nodes) < job['num_nodes']:
+            job['reason'] = 'Resources'
+            continue
+        job['nodes'] = nodes
+        job['devices'] = free[nodes[0]]['gpus'][:job['gpus']]
+        for name in nodes:
+            free[name]['cpus'] -= job['cpus']
+            free[name]['mem'] -= job['mem']
+            free[name]['gpus'] = free[name]['gpus'][job['gpus']:]
+        start(state, job)
+        if job['array_job_id'] is not None:
+            running_per_array[job['array_job_id']] = running_per_array.get(job['array_job_id'], 0) + 1
+    return active or any(job['state'] == 'RUNNING' for job in state['jobs'])
+
+def start(state, job):
+    """Runs the batch script of a job as a local process."""
+    os.makedirs(join(HOME, 'exit'), exist_ok=True)
+    env = dict(state['envs'].get(job['env'], os.environ))
+    env['SLURM_JOB_ID'] = str(job['id'])
+    env['SLURM_JOBID'] = str(job['id'])
+    env['SLURM_JOB_NAME'] = job['name']
+    env['SLURM_JOB_NODELIST'] = ','.join(job['nodes'])
+    env['SLURM_JOB_NUM_NODES'] = str(len(job['nodes']))
+    env['SLURM_NTASKS'] = str(job.get('ntasks', 1))
+    env['SLURM_SUBMIT_DIR'] = job['chdir']
+    env['SLURMD_NODENAME'] = job['nodes'][0]
+    env['FAKESLURM_HOME'] = HOME
+    env['CUDA_VISIBLE_DEVICES'] = ','.join(str(device) for device in job['devices'])
+    if job['array_job_id'] is not None:
+        env['SLURM_ARRAY_JOB_ID'] = str(job['array_job_id'])
+        env['SLURM_ARRAY_TASK_ID'] = str(job['task_id'])
+    mode = 'a' if job['append'] else 'w'
+    output = expand_pattern(job['output'], job)
+    error = expand_pattern(job['error'], job)
+    for path in [output, error]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    exit_file = join(HOME, 'exit', str(job['id']))
+    cwd = job['chdir'] if os.path.isdir(job['chdir']) else HOME
+    with open(output, mode) as out:
+        err = out if error == output else open(error, mode)
+        proc = subprocess.Popen(['bash', '-c', 'bash "$0"; echo $? > "$1"', job['script'], exit_file], stdin=subprocess.DEVNULL,
+                                stdout=out, stderr=err, cwd=cwd, env=env, start_new_session=True)
+        if err is not out: err.close()
+    job['pid'] = proc.pid
+    job['state'] = 'RUNNING'
+    job['reason'] = 'None'
+    job['start'] = time.time()
+
+def pid_alive(pid):
+    if pid is None: return False
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+def kill(job):
+    if job['pid'] is None: return
+    try:
+        os.killpg(job['pid'], signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def job_field(job, name, now):
+    """Gets a column of squeue -O and sacct --format for a job."""
+    name = name.lower()
+    elapsed = 0 if job['start'] is None else (job['end'] or now) - job['start']
+    if name in ['jobid', 'jobidraw']: return display_id(job)
+    if name in ['jobname', 'name']: return job['name']
+    if name in ['state', 'statecompact']:
+        state_name = job['state']
+        return STATE_CODES[state_name] if name == 'statecompact' else state_name
+    if name == 'partition': return job['partition']
+    if name == 'account': return job['account']
+    if name in ['user', 'username']: return job['user']
+    if name in ['elapsed', 'timeused']: return format_duration(elapsed)
+    if name in ['timelimit']: return 'UNLIMITED' if job['time_limit'] is None else format_duration(job['time_limit'])
+    if name == 'start': return format_timestamp(job['start'])
+    if name == 'end': return format_timestamp(job['end'])
+    if name == 'endtime':
+        if job['end'] is not None: return format_timestamp(job['end'])
+        if job['start'] is not None and job['time_limit'] is not None: return format_timestamp(job['start'] + job['time_limit'])
+        return 'N/A'
+    if name in ['submit', 'submittime']: return format_timestamp(job['submit'])
+    if name in ['nodelist']: return ','.join(job['nodes']) if len(job['nodes']) > 0 else 'None assigned'
+    if name in ['allocgres', 'gres', 'tres-per-node']: return 'gpu:{0}'.format(job['gpus']) if job['gpus'] > 0 else '(null)'
+    if name in ['alloctres']: return 'cpu={0},mem={1}G,node={2},gres/gpu={3}'.format(job['cpus'], job['mem'], job['num_nodes'], job['gpus'])
+    if name in ['cpus-per-task', 'alloccpus', 'numcpus']: return str(job['cpus'])
+    if name in ['minmemory', 'reqmem']: return '{0}G'.format(job['mem'])
+    if name in ['nnodes', 'numnodes']: return str(job['num_nodes'])
+    if name == 'reason': return job['reason']
+    if name == 'exitcode': return '{0}:0'.format(job['exit_code'] or 0)
+    if name == 'comment': return job['comment']
+    if name in ['arrayjobid']: return str(job['array_job_id'] or job['id'])
+    if name in ['arraytaskid']: return 'N/A' if job['task_id'] is None else str(job['task_id'])
+    return ''
+
+def collapse_pending(jobs):
+    """Shows the pending tasks of an array as one line like squeue and sacct do without -r."""
+    rows = []
+    pending = {}
+    for job in jobs:
+        if job['state'] == 'PENDING' and job['array_job_id'] is not None:
+            if job['array_job_id'] not in pending:
+                pending[job['array_job_id']] = dict(job, task_ids=[])
+                rows.append(pending[job['array_job_id']])
+            pending[job['array_job_id']]['task_ids'].append(job['task_id'])
+        else:
+            rows.append(job)
+    for row in pending.values():
+        task_ids = row['task_ids']
+        if len(task_ids) > 1:
+            text = '{0}-{1}'.format(task_ids[0], task_ids[-1]) if task_ids == list(range(task_ids[0], task_ids[-1] + 1)) else ','.join(str(task_id) for task_id in task_ids)
+            if row['throttle'] is not None: text += '%{0}'.format(row['throttle'])
+            row['task_id'] = '[{0}]'.format(text)
+    return rows
+
+def parse_format(spec, default_width):
+    """Parses a list like JobID%30,State,NodeList into (name, width) pairs."""
+    columns = []
+    for item in spec.split(','):
+        item = item.strip()
+        if item == '': continue
+        name, _, width = item.partition('%')
+        if ':' in name:
+            name, _, width = name.partition(':')
+        columns.append((name, int(width.lstrip('.')) if width.lstrip('.').isdigit() else default_width))
+    return columns
+
+def print_table(rows, columns, now, header=True, delimiter=None, trailing=False, right=False, separator=False, labels=None):
+    lines = []
+    if header and labels is not None:
+        lines.append([labels.get(name.lower(), name.upper()) for name, width in columns])
+    elif header:
+        lines.append([name for name, width in columns])
+        if separator: lines.append(['-'*width for name, width in columns])
+    for row in rows:
+        lines.append([job_field(row, name, now) for name, width in columns])
+    for values in lines:
+        if delimiter is not None:
+            print(delimiter.join(values) + (delimiter if trailing else ''))
+        else:
+            cells = []
+            for value, (name, width) in zip(values, columns):
+                value = value[:width]
+                cells.append(value.rjust(width) if right else value.ljust(width))
+            print(' '.join(cells).rstrip())
+
+def squeue(argv):
+    options, _ = parse_options(argv, SQUEUE_FLAGS, SQUEUE_OPTIONS)
+    with locked_state() as state:
+        jobs = [job for job in state['jobs'] if job['state'] in ACTIVE_STATES]
+    if 'user' in options:
+        users = options['user'].split(',')
+        jobs = [job for job in jobs if job['user'] in users]
+    if 'states' in options:
+        wanted = [state_name.upper() for state_name in options['states'].split(',')]
+        jobs = [job for job in jobs if job['state'] in wanted or STATE_CODES[job['state']] in wanted]
+    if 'jobs' in options:
+        refs = options['jobs'].split(',')
+        jobs = [job for job in jobs if display_id(job) in refs or str(job['array_job_id'] or job['id']) in refs]
+    if not (options.get('array') or options.get('r')):
+        jobs = collapse_pending(jobs)
+    now = time.time()
+    header = not (options.get('noheader') or options.get('h'))
+    if 'Format' in options:
+        print_table(jobs, parse_format(options['Format'], 20), now, header, labels=SQUEUE_LABELS)
+        return 0
+    codes = {'i': 'jobid', 'j': 'name', 'u': 'user', 'T': 'state', 't': 'statecompact', 'P': 'partition', 'D': 'nnodes', 'R': 'reason',
+             'M': 'timeused', 'l': 'timelimit', 'N': 'nodelist', 'a': 'account', 'b': 'gres', 'm': 'minmemory', 'C': 'numcpus', 'S': 'start',
+             'V': 'submittime', 'e': 'endtime', 'F': 'arrayjobid', 'K': 'arraytaskid'}
+    fmt = options.get('format', '%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R')
+    labels = {'i': 'JOBID', 'j': 'NAME', 'T': 'STATE', 't': 'ST', 'D': 'NODES', 'R': 'NODELIST(REASON)', 'M': 'TIME',
+              'l': 'TIME_LIMIT', 'b': 'TRES_PER_NODE', 'm': 'MIN_MEMORY', 'C': 'CPUS', 'S': 'START_TIME', 'V': 'SUBMIT_TIME',
+              'e': 'END_TIME', 'F': 'ARRAY_JOB_ID', 'K': 'ARRAY_TASK_ID'}
+    fields = re.findall(r'%(\.?)(\d*)([a-zA-Z])', fmt)
+    rows = []
+    if header:
+        rows.append([labels.get(code, codes.get(code, code).upper()) for _, _, code in fields])
+    for job in jobs:
+        cells = []
+        for _, _, code in fields:
+            if code == 'R' and job['state'] != 'PENDING':
+                cells.append(job_field(job, 'nodelist', now))
+            elif code == 'R':
+                cells.append('(' + job_field(job, 'reason', now) + ')')
+            else:
+                cells.append(job_field(job, codes.get(code, ''), now))
+        rows.append(cells)
+    for cells in rows:
+        for i, (dot, width, _) in enumerate(fields):
+            if width != '':
+                cells[i] = cells[i][:int(width)].rjust(int(width)) if dot else cells[i].ljust(int(width))
+        print(' '.join(cells))
+    return 0
+
+def sacct(argv):
+    options, _ = parse_options(argv, SACCT_FLAGS, SACCT_OPTIONS)
+    with locked_state() as state:
+        jobs = list(state['jobs'])
+    start = options.get('starttime')
+    if start is None:
+        start = datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
+    else:
+        start = datetime.datetime.fromisoformat(start).timestamp()
+    jobs = [job for job in jobs if job['submit'] >= start or job['end'] is None or job['end'] >= start]
+    if not (options.get('allusers') or options.get('a')):
+        users = options.get('user', getpass.getuser()).split(',')
+        jobs = [job for job in jobs if job['user'] in users]
+    if 'jobs' in options:
+        refs = options['jobs'].split(',')
+        jobs = [job for job in jobs if display_id(job) in refs or str(job['array_job_id'] or job['id']) in refs]
+    if 'state' in options:
+        wanted = [state_name.upper() for state_name in options['state'].split(',')]
+        jobs = [job for job in jobs if job['state'] in wanted or STATE_CODES[job['state']] in wanted]
+    jobs = collapse_pending(jobs)
+    columns = parse_format(options.get('format', 'JobID,JobName,Partition,Account,AllocCPUS,State,ExitCode'), 10)
+    header = not (options.get('noheader') or options.get('n'))
+    if options.get('parsable') or options.get('p'):
+        print_table(jobs, columns, time.time(), header, delimiter='|', trailing=True)
+    elif options.get('parsable2') or options.get('P'):
+        print_table(jobs, columns, time.time(), header, delimiter='|')
+    else:
+        print_table(jobs, columns, time.time(), header, right=True, separator=True)
+    return 0
+
+def scontrol(argv):
+    if argv[:2] == ['show', 'config']:
+        print('Configuration data as of {0}'.format(format_timestamp(time.time())))
+        print('ClusterName             = fakeslurm')
+        print('MaxArraySize            = {0}'.format(MAX_ARRAY_SIZE))
+        print('MaxJobCount             = 10000')
+        print('SLURM_VERSION           = 21.08.0')
+        return 0
+    if argv[:2] == ['show', 'nodes'] or argv[:2] == ['show', 'node']:
+        with locked_state() as state:
+            free = free_resources(state)
+        for name in node_names():
+            print('NodeName={0} CPUTot={1} CPUAlloc={2} RealMemory={3} Gres=gpu:{4} GresUsed=gpu:{5}'.format(
+                name, CPUS_PER_NODE, CPUS_PER_NODE - free[name]['cpus'], MEM_PER_NODE*1024, GPUS_PER_NODE, GPUS_PER_NODE - len(free[name]['gpus'])))
+            print('')
+        return 0
+    print('scontrol: error: fakeslurm only supports show config and show nodes', file=sys.stderr)
+    return 1
+
+def sacctmgr(argv):
+    fields = []
+    for arg in argv:
+        if arg.lower().startswith('format='):
+            fields = arg.split('=', 1)[1].split(',')
+    values = []
+    for field in fields:
+        if field.lower() == 'maxsubmit':
+            values.append('' if MAX_SUBMIT is None else str(MAX_SUBMIT))
+        elif field.lower() == 'user':
+            values.append(getpass.getuser())
+        else:
+            values.append('')
+    print('|'.join(values))
+    return 0
+
+def scancel(argv):
+    options, refs = parse_options(argv, set(), {'u': 'user'})
+    with locked_state() as state:
+        for ref in refs:
+            for job in find_jobs(state, ref):
+                if job['state'] not in ACTIVE_STATES: continue
+                if job['state'] == 'RUNNING': kill(job)
+                finish(job, 'CANCELLED', 0)
+    return 0
+
+def run_tasks(args, ntasks, env=None):
+    """Runs one process per task of a step, like srun. Returns the highest exit code."""
+    env = dict(os.environ) if env is None else env
+    procs = []
+    for task_id in range(ntasks):
+        task_env = dict(env)
+        task_env['SLURM_PROCID'] = str(task_id)
+        task_env['SLURM_LOCALID'] = str(task_id)
+        task_env['SLURM_STEP_NUM_TASKS'] = str(ntasks)
+        procs.append(subprocess.Popen(args, env=task_env))
+    return max(proc.wait() for proc in procs)
+
+def srun(argv):
+    """Runs a job step.
+
+    Inside a job, the step runs one process per task of the job unless
+    -n/--ntasks is given, and --exclusive steps get their own GPUs of the
+    allocation.
+
+    """
+    options, args = parse_options(argv, set(['exclusive', 'overcommit', 'overlap', 'exact']),
+                                  {'N': 'nodes', 'n': 'ntasks', 'c': 'cpus-per-task', 'G': 'gpus', 'J': 'job-name'})
+    job_id = os.environ.get('SLURM_JOB_ID')
+    if 'ntasks' in options:
+        ntasks = int(options['ntasks'])
+    elif 'ntasks-per-node' in options:
+        ntasks = int(options['ntasks-per-node'])*int(options.get('nodes', 1))
+    else:
+        ntasks = int(os.environ.get('SLURM_NTASKS', 1)) if job_id is not None else 1
+    gpus = options.get('gpus', options.get('gpus-per-task', options.get('gres')))
+    devices = [device for device in os.environ.get('CUDA_VISIBLE_DEVICES', '').split(',') if device != '']
+    if job_id is None or gpus is None or len(devices) == 0:
+        return run_tasks(args, ntasks)
+    gpus = int(str(gpus).split(':')[-1])
+    step_dir = join(HOME, 'steps', job_id)
+    os.makedirs(step_dir, exist_ok=True)
+    # a step holds a lock per device while it runs; steps wait until enough devices are free
+    while True:
+        held = []
+        for device in devices:
+            lock = open(join(step_dir, '{0}.lock'.format(device)), 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                held.append((device, lock))
+            except OSError:
+                lock.close()
+            if len(held) == gpus: break
+        if len(held) == gpus: break
+        for device, lock in held:
+            lock.close()
+        time.sleep(0.1)
+    env = dict(os.environ)
+    env['CUDA_VISIBLE_DEVICES'] = ','.join(device for device, lock in held)
+    try:
+        return run_tasks(args, ntasks, env)
+    finally:
+        for device, lock in held:
+            lock.close()
+
+COMMANDS = {'sbatch': sbatch, 'squeue': squeue, 'sacct': sacct, 'scontrol': scontrol, 'sacctmgr': sacctmgr, 'scancel': scancel, 'srun': srun, 'daemon': daemon}
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print('Usage: python -m gpuscheduler.fakeslurm {{{0}}} [args]'.format(','.join(sorted(COMMANDS))), file=sys.stderr)
+        return 1
+    return COMMANDS[sys.argv[1]](sys.argv[2:])
+
+if __name__ == '__main__':
+    sys.exit(main())
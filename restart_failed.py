@@ -3,6 +3,7 @@ import argparse
 import subprocess
 import shlex
 import datetime
+import json
 
 parser = argparse.ArgumentParser('Script to restart failed or timeouted jobs.')
 parser.add_argument('--startid', type=int, required=True, help='Restart all failed or timeouted jobs with this jobid or greater.')
@@ -23,6 +24,19 @@ def execute_and_return(strCMD):
     out, err = out.decode("UTF-8").strip(), err.decode("UTF-8").strip()
     return out, err
 
+def read_manifest_entry(manifest, array_id):
+    """Reads the entry of an array task from a manifest of HyakScheduler.run_jobs(manifest=True).
+
+    All lines of the manifest have the same width, so the entry is found with a single seek.
+
+    """
+    with open(manifest) as f:
+        width = len(f.readline())
+        f.seek(array_id*width)
+        line = f.read(width)
+    if line.strip() == '': return None
+    return json.loads(line)
+
 
 cmd = 'sacct -X --format="Jobid%30,State%20,JobName%250,NodeList" --noheader -S {0} -p'.format(datetime.date.today()-datetime.timedelta(days=args.days_back))
 
@@ -46,6 +60,7 @@ else:
 banned = set()
 restarts = set()
 script2data = {}
+manifest_scripts = {}
 for l in lines:
     data = [col for col in l.split('|') if len(col) > 0]
     jobstr = data[0]
@@ -73,6 +88,13 @@ for l in lines:
             lines = f.readlines()
         if array_id >= len(lines): continue
         script_name = lines[array_id].strip()
+    elif script.endswith('.jsonl'):
+        if not os.path.exists(script): continue
+        entry = read_manifest_entry(script, array_id)
+        if entry is None: continue
+        script_name = entry['path']
+        # the script of the task is only written to its own file when it is restarted
+        manifest_scripts[script_name] = entry['script']
     else:
         script_name = script
 
@@ -102,6 +124,9 @@ for script_name in restarts:
         data = script2data[script_name]
         print('Originally: Job {0} with State {1} on NodeList {2}'.format(*data[-3:]))
         script, array_id, jobstr, state, node = data
+        if script_name in manifest_scripts and not os.path.exists(script_name):
+            with open(script_name, 'w') as f:
+                f.write(manifest_scripts[script_name])
         if 'array_jobs' in script:
             print('Restarting script: {0}'.format(script_name))
             cmd = 'sbatch --exclude={1} {0}'.format(script_name, ','.join(banned))